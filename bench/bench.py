@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+"""End-to-end benchmark of cut-m without Google access.
+
+A synthetic source video is made by ffmpeg lavfi sources and served
+with a worksheet of N fragments by local stand-ins (see `standin.py`).
+The stages are run one after another by the same code as a real run
+and their throughput is reported. Results are compared with the saved
+baseline, so a change that makes a stage slower shows up"""
+
+import argparse
+import json
+import pathlib
+import requests
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+from concurrent import futures
+
+sys.path.insert(0, f"{pathlib.Path(__file__).resolve().parents[1]}")
+
+import cut  # noqa: E402
+import download  # noqa: E402
+import driveindex  # noqa: E402
+import fragcache  # noqa: E402
+import google_serve as gs  # noqa: E402
+import probe  # noqa: E402
+import standin  # noqa: E402
+import upload  # noqa: E402
+import utils as ut  # noqa: E402
+
+
+VIDEO_ID, FOLDER_ID, SHEET_ID = "video", "folder", "sheet"
+COLUMNS = gs.TabColumns("Slice", "Start", "End", "Name")
+HEAD_ROW, N_HEAD_ROWS = 2, 2
+
+
+def make_video(path, length, bitrate, size="1280x720", rate=25):
+    """Make H.264/AAC video of `length` seconds with keyframes
+       every 2 seconds, unless it is made before"""
+    if path.exists():
+        return path
+    args = [
+        f"{cut.ffmpeg}",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={rate}",
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+        "-t", f"{length}",
+        "-c:v", "libx264", "-preset", "ultrafast",
+        "-b:v", f"{bitrate}", "-maxrate", f"{bitrate}",
+        "-bufsize", f"{bitrate}", "-g", f"{2*rate}",
+        "-c:a", "aac", "-b:a", "128k",
+        "-y", f"{path}",
+    ]
+    tmp = path.with_name(f".{path.name}")
+    p = sp.run([*args[:-1], f"{tmp}"], capture_output=True)
+    if p.returncode:
+        raise RuntimeError(ut.decode(p.stderr))
+    tmp.replace(path)
+    return path
+
+
+def make_sheet(length, n):
+    """Return worksheet rows with `n` checked fragments evenly spread
+       over `length` seconds and as many unchecked ones"""
+    rows = [["Bench"], ["#", *COLUMNS]]
+    step = length / (2*n)
+    for i in range(2*n):
+        s = i*step
+        e = s + max(min(step*0.8, 30), 2)
+        rows.append([f"{i+1}", "TRUE" if i % 2 == 0 else "FALSE",
+                     ut.to_hhmmss(s), ut.to_hhmmss(min(e, length)),
+                     f"fragment {i+1}"])
+    return rows
+
+
+class Worksheet:
+    """Worksheet read from the stand-in Sheets values API,
+       only the methods used by `google_serve.load_table`"""
+
+    def __init__(self, session, url, id):
+        self.session = session
+        self.url = f"{url}/v4/spreadsheets/{id}/values:batchGet"
+
+    def batch_get(self, ranges, major_dimension="ROWS"):
+        r = self.session.get(self.url, params={
+            "ranges": ranges, "majorDimension": major_dimension
+        })
+        r.raise_for_status()
+        return [v.get("values", []) for v in r.json()["valueRanges"]]
+
+    def row_values(self, row):
+        r = self.session.get(self.url, params={
+            "ranges": f"A{row}:ZZ{row}", "majorDimension": "ROWS"
+        })
+        r.raise_for_status()
+        values = r.json()["valueRanges"][0].get("values", [])
+        return values[0] if values else []
+
+
+class Stage:
+    """Wall time and amount of work of benchmark stage"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.seconds = 0.
+        self.bytes = 0
+        self.items = 0
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.start
+        return self
+
+    def as_dict(self):
+        dt = max(self.seconds, 1e-9)
+        return {
+            "seconds": round(self.seconds, 3),
+            "bytes": self.bytes,
+            "items": self.items,
+            "MB/s": round(self.bytes / dt / 1e6, 2),
+            "items/s": round(self.items / dt, 2),
+        }
+
+
+def run(opts, video, workdir):
+    """Run all stages on source `video`, return results"""
+    store = standin.Store()
+    store.add_file(VIDEO_ID, video.name, video.read_bytes())
+    store.sheets[SHEET_ID] = make_sheet(opts.length, opts.fragments)
+    server = standin.serve(store)
+    url = f"http://127.0.0.1:{server.server_port}"
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=32)
+    session.mount("http://", adapter)
+    stages = {}
+
+    try:
+        stage = Stage()
+        _, tm_codes = gs.extract_timing(Worksheet(session, url, SHEET_ID),
+                                        HEAD_ROW, N_HEAD_ROWS, COLUMNS)
+        stage.items = len(tm_codes)
+        stages["sheet"] = stage.stop()
+
+        stage = Stage()
+        target = workdir/video.name
+        size = video.stat().st_size
+        loader = download.Downloader(
+            session, opts.download_workers,
+            url=f"{url}/drive/v3/files/{{id}}")
+        loader.download(VIDEO_ID, target, size)
+        stage.bytes, stage.items = size, 1
+        stages["download"] = stage.stop()
+
+        fragdir = workdir/"fragments"
+        fragdir.mkdir()
+        manifest = fragcache.Manifest(fragdir, probe.checksum(target))
+        spans = [(ut.to_seconds(tm.start), ut.to_seconds(tm.end))
+                 for tm in tm_codes]
+        frags = [cut.make_filename(target, tm, fragdir) for tm in tm_codes]
+        stage = Stage()
+        batch = info = None
+        if opts.method == "batch":
+            batch = cut.Batch(target, [cut.Fragment(s, e, manifest.temp(f))
+                                       for (s, e), f in zip(spans, frags)],
+                              probe.keyframes(target))
+        elif opts.method == "smart":
+            info = probe.probe(target)
+
+        def make(i):
+            (s, e), frag = spans[i], frags[i]
+            tmp = manifest.temp(frag)
+            if info is not None:
+                ok = cut.make_smart_fragment(target, s, e, tmp, info)
+            elif batch is not None:
+                ok = batch.make_fragment(tmp)
+            else:
+                ok = cut.make_fragment(target, ut.to_hhmmss(s),
+                                       ut.to_hhmmss(e), tmp)
+            if not ok:
+                raise RuntimeError(f"failed to cut {frag.name}")
+            manifest.commit(frag, manifest.key(s, e, opts.method))
+
+        with futures.ThreadPoolExecutor(opts.workers) as pool:
+            list(pool.map(make, range(len(frags))))
+        stage.bytes = sum(f.stat().st_size for f in frags)
+        stage.items = len(frags)
+        stages["cut"] = stage.stop()
+
+        stage = Stage()
+        uploader = upload.Uploader(
+            session, upload.Sessions(workdir/"uploads.json"),
+            chunk_size=opts.chunk_size*1024*1024,
+            url=f"{url}/upload/drive/v3/files")
+        with futures.ThreadPoolExecutor(opts.upload_workers) as pool:
+            list(pool.map(lambda f: uploader.upload(f, FOLDER_ID), frags))
+        stage.bytes = sum(f.stat().st_size for f in frags)
+        stage.items = len(frags)
+        stages["upload"] = stage.stop()
+
+        stage = Stage()
+        folder = driveindex.FolderIndex(session, FOLDER_ID,
+                                        workdir/"drive_index.json",
+                                        url=f"{url}/drive/v3")
+        folder.refresh()
+        stage.items = len(folder.files)
+        if stage.items != len(frags):
+            raise RuntimeError(f"{stage.items} of {len(frags)} fragment(s)"
+                               " found in the folder")
+        stages["list"] = stage.stop()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return stages
+
+
+# the measure of every stage compared with the baseline
+MEASURES = {
+    "sheet": "items/s",
+    "download": "MB/s",
+    "cut": "items/s",
+    "upload": "MB/s",
+    "list": "items/s",
+}
+
+
+def params(opts):
+    return {k: getattr(opts, k) for k in (
+        "length", "bitrate", "fragments", "method", "workers",
+        "download_workers", "upload_workers", "chunk_size",
+    )}
+
+
+def compare(results, baseline, tolerance):
+    """Print results against `baseline`, return number of regressions"""
+    n = 0
+    print(f"{'stage':<10}{'measure':>10}{'value':>12}{'baseline':>12}")
+    for name, measure in [*MEASURES.items(), ("total", "seconds")]:
+        value = results["stages"][name][measure]
+        base = (baseline or {}).get("stages", {}).get(name, {}).get(measure)
+        line = f"{name:<10}{measure:>10}{value:>12}"
+        if base is not None:
+            worse = value > base*(1 + tolerance) if measure == "seconds" \
+                else value < base*(1 - tolerance)
+            line += f"{base:>12}"
+            if worse:
+                line += "  [REGRESSION]"
+                n += 1
+        print(line)
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--length", type=int, default=600,
+                        help="source video length in seconds")
+    parser.add_argument("--bitrate", default="4M",
+                        help="source video bitrate")
+    parser.add_argument("--fragments", type=int, default=20,
+                        help="number of fragments to cut")
+    parser.add_argument("--method", choices=["copy", "batch", "smart"],
+                        default="copy", help="way to cut fragments")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--upload-workers", type=int, default=2)
+    parser.add_argument("--chunk-size", type=int, default=8,
+                        help="upload chunk size in MB")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="run several times and take the best")
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--media", type=pathlib.Path,
+                        default=pathlib.Path(__file__).parent/"media",
+                        help="directory to keep synthetic videos")
+    parser.add_argument("--baseline", type=pathlib.Path,
+                        default=pathlib.Path(__file__).parent
+                        / "baseline.json")
+    parser.add_argument("--save", action="store_true",
+                        help="save results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown to report as regression")
+    opts = parser.parse_args()
+
+    cut.ffmpeg = shutil.which(opts.ffmpeg) or opts.ffmpeg
+    opts.media.mkdir(parents=True, exist_ok=True)
+    video = make_video(opts.media/f"src-{opts.length}s-{opts.bitrate}.mp4",
+                       opts.length, opts.bitrate)
+    best = None
+    for _ in range(max(opts.repeat, 1)):
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            stages = run(opts, video, pathlib.Path(tmp))
+            total = time.perf_counter() - start
+        if best is None or total < best[1]:
+            best = stages, total
+    stages, total = best
+    results = {
+        "params": params(opts),
+        "stages": {k: v.as_dict() for k, v in stages.items()},
+    }
+    results["stages"]["total"] = {"seconds": round(total, 3)}
+
+    baseline = None
+    if opts.baseline.exists():
+        with opts.baseline.open("r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != results["params"]:
+            print("[WARNING] baseline is made with other parameters,"
+                  " not compared")
+            baseline = None
+    n = compare(results, baseline, opts.tolerance)
+    if opts.save:
+        with opts.baseline.open("w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to '{opts.baseline}'")
+    return 1 if n and not opts.save else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
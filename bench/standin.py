@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""Local stand-ins for the Google Drive and Sheets endpoints used by cut-m:
+   ranged download, listing and changes feed, resumable upload and
+   the Sheets values:batchGet API. Data is kept in memory"""
+
+import hashlib
+import http.server
+import json
+import re
+import threading
+
+from urllib.parse import parse_qs, urlparse
+
+
+class Store:
+    """Files, uploads and worksheets served by the stand-in"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}     # id -> metadata with "data"
+        self.sessions = {}  # upload session id -> state
+        self.sheets = {}    # spreadsheet id -> list of rows
+        self.changes = []   # file ids in order of change
+        self.n_sessions = 0
+
+    def add_file(self, id, name, data, parent="root", mime="video/mp4",
+                 properties=None):
+        with self.lock:
+            self.files[id] = {
+                "id": id,
+                "name": name,
+                "mimeType": mime,
+                "size": f"{len(data)}",
+                "md5Checksum": hashlib.md5(data).hexdigest(),
+                "parents": [parent],
+                "trashed": False,
+                "appProperties": properties or {},
+                "data": data,
+            }
+            self.changes.append(id)
+
+    def meta(self, id):
+        return {k: v for k, v in self.files[id].items() if k != "data"}
+
+
+def _column(a1):
+    n = 0
+    for c in a1:
+        n = 26*n + ord(c) - ord("A") + 1
+    return n - 1
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None  # set by `serve`
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body=b"", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", f"{len(body)}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(n)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        q = parse_qs(url.query)
+        if m := re.fullmatch(r"/drive/v3/files/([^/]+)", url.path):
+            return self._download(m.group(1))
+        if url.path == "/drive/v3/files":
+            return self._list(q)
+        if url.path == "/drive/v3/changes/startPageToken":
+            return self._send(200, {
+                "startPageToken": f"{len(self.store.changes)}"
+            })
+        if url.path == "/drive/v3/changes":
+            return self._changes(q)
+        if m := re.fullmatch(r"/v4/spreadsheets/([^/]+)/values:batchGet",
+                             url.path):
+            return self._values(m.group(1), q)
+        self._send(404)
+
+    def _download(self, id):
+        file = self.store.files.get(id)
+        if file is None:
+            return self._send(404)
+        data = file["data"]
+        rng = self.headers.get("Range")
+        if rng is None:
+            return self._send(200, data)
+        a, b = map(int, re.fullmatch(r"bytes=(\d+)-(\d+)", rng).groups())
+        b = min(b, len(data) - 1)
+        self._send(206, data[a:b+1],
+                   {"Content-Range": f"bytes {a}-{b}/{len(data)}"})
+
+    def _list(self, q):
+        parent = re.search(r"'([^']+)' in parents", q["q"][0]).group(1)
+        with self.store.lock:
+            files = [self.store.meta(id) for id, f in self.store.files.items()
+                     if parent in f["parents"] and not f["trashed"]]
+        self._send(200, {"files": files})
+
+    def _changes(self, q):
+        start = int(q["pageToken"][0])
+        with self.store.lock:
+            ids = self.store.changes[start:]
+            changes = [{"fileId": id, "file": self.store.meta(id)}
+                       for id in ids]
+            token = f"{len(self.store.changes)}"
+        self._send(200, {"changes": changes, "newStartPageToken": token})
+
+    def _values(self, id, q):
+        rows = self.store.sheets[id]
+        by_columns = q.get("majorDimension") == ["COLUMNS"]
+        ranges = []
+        for r in q.get("ranges", []):
+            r = r.split("!")[-1]
+            m = re.fullmatch(r"([A-Z]+)(\d+)(?::([A-Z]+)(\d*))?", r)
+            c0, r0 = _column(m.group(1)), int(m.group(2)) - 1
+            c1, r1 = c0, r0 + 1
+            if m.group(3):
+                c1 = _column(m.group(3))
+                r1 = int(m.group(4)) if m.group(4) else len(rows)
+            block = [[row[c] if c < len(row) else ""
+                      for c in range(c0, c1 + 1)] for row in rows[r0:r1]]
+            if by_columns:
+                block = [list(c) for c in zip(*block)]
+            for line in block:
+                while line and line[-1] == "":
+                    line.pop()
+            while block and not block[-1]:
+                block.pop()
+            ranges.append({"range": r, "values": block})
+        self._send(200, {"spreadsheetId": id, "valueRanges": ranges})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/upload/drive/v3/files":
+            return self._send(404)
+        meta = json.loads(self._body() or b"{}")
+        with self.store.lock:
+            sid = f"{self.store.n_sessions}"
+            self.store.n_sessions += 1
+            self.store.sessions[sid] = {
+                "meta": meta,
+                "size": int(self.headers.get("X-Upload-Content-Length",
+                                             -1)),  # may be unknown
+                "mime": self.headers.get("X-Upload-Content-Type"),
+                "data": bytearray(),
+            }
+        host = self.headers["Host"]
+        self._send(200, headers={
+            "Location": f"http://{host}/upload/session/{sid}"
+        })
+
+    def do_PUT(self):
+        m = re.fullmatch(r"/upload/session/(\d+)", urlparse(self.path).path)
+        if m is None or m.group(1) not in self.store.sessions:
+            return self._send(404)
+        session = self.store.sessions[m.group(1)]
+        body = self._body()
+        rng = re.fullmatch(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)",
+                           self.headers["Content-Range"])
+        if rng.group(3) != "*":
+            session["size"] = int(rng.group(3))
+        if rng.group(1) is not None:
+            if int(rng.group(1)) != len(session["data"]):
+                return self._send(400)
+            session["data"] += body
+        if len(session["data"]) != session["size"]:
+            headers = {}
+            if session["data"]:
+                headers["Range"] = f"bytes=0-{len(session['data']) - 1}"
+            return self._send(308, headers=headers)
+
+        id = f"up{m.group(1)}"
+        if id not in self.store.files:
+            self.store.add_file(id, session["meta"]["name"],
+                                bytes(session["data"]),
+                                session["meta"]["parents"][0],
+                                session["mime"],
+                                session["meta"].get("appProperties"))
+        self._send(200, self.store.meta(id))
+
+    def do_DELETE(self):
+        m = re.fullmatch(r"/upload/session/(\d+)", urlparse(self.path).path)
+        if m is None or self.store.sessions.pop(m.group(1), None) is None:
+            return self._send(404)
+        self._send(204)
+
+
+def serve(store, port=0):
+    """Start stand-in server in background thread, return it.
+       Its base URL is f"http://127.0.0.1:{server.server_port}" """
+    handler = type("StandIn", (Handler,), {"store": store})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
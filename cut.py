@@ -1,7 +1,20 @@
 #!/usr/bin/env python3
 
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import json
+import math
+import os
+import shutil
 import subprocess as sp
+import threading
 
+from collections import namedtuple
+from concurrent import futures
+
+import probe
 import utils as ut
 
 
@@ -20,17 +33,346 @@ def correct_time_by(time, seconds):
 ffmpeg = None  # set in main module
 
 
-def make_fragment(video, start, end, outfile):
-    ut.logger().debug(f"cutting {outfile.resolve()}")
-    args = [
+def fragment_args(video, start, end, outfile):
+    """Return ffmpeg arguments to cut fragment from `start` to `end`"""
+    return [
         f"{ffmpeg}",
         "-ss", start, "-to", end,
         "-i", f"{video}",
         "-c:v", "copy", "-c:a", "copy",
         "-y", f"{outfile.resolve()}",
     ]
-    p = sp.run(args, capture_output=True)
+
+
+def make_fragment(video, start, end, outfile):
+    ut.logger().debug(f"cutting {outfile.resolve()}")
+    p = ut.run_process(fragment_args(video, start, end, outfile))
     if p.returncode:
         ut.logger().error(ut.decode(p.stderr))
         return False
     return True
+
+
+async def make_fragment_async(video, start, end, outfile):
+    """Like `make_fragment`, but wait for ffmpeg in asyncio event loop"""
+    ut.logger().debug(f"cutting {outfile.resolve()}")
+    p = await asyncio.create_subprocess_exec(
+        *fragment_args(video, start, end, outfile),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, err = await p.communicate()
+    if p.returncode:
+        ut.logger().error(ut.decode(err))
+        return False
+    return True
+
+
+_FRAGMENTED = ["-movflags", "frag_keyframe+empty_moov+default_base_moof"]
+
+# containers which can be written to a pipe, by file suffix
+STREAM_FORMATS = {
+    ".mp4": ["-f", "mp4", *_FRAGMENTED],
+    ".m4v": ["-f", "mp4", *_FRAGMENTED],
+    ".mov": ["-f", "mov", *_FRAGMENTED],
+    ".mkv": ["-f", "matroska"],
+    ".webm": ["-f", "webm"],
+    ".ts": ["-f", "mpegts"],
+}
+
+
+def open_stream(video, start, end, outfile, stderr):
+    """Start ffmpeg to cut fragment from `start` to `end` (hh:mm:ss) into
+       its stdout in a streamable container of the `outfile` format (see
+       `STREAM_FORMATS`), errors go to file `stderr`. Return the process
+       or None if the format can't be streamed"""
+    fmt = STREAM_FORMATS.get(outfile.suffix.lower())
+    if fmt is None:
+        return None
+    ut.logger().debug(f"streaming {outfile.name}")
+    return sp.Popen([
+        f"{ffmpeg}",
+        "-ss", start, "-to", end,
+        "-i", f"{video}",
+        "-c:v", "copy", "-c:a", "copy",
+        *fmt, "pipe:1",
+    ], stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=stderr)
+
+
+def _run(args):
+    p = ut.run_process([f"{ffmpeg}", *args])
+    if p.returncode:
+        ut.logger().error(ut.decode(p.stderr))
+    return p.returncode == 0
+
+
+def ceil_ms(t):
+    """Return time `t` in seconds rounded up to milliseconds, so seeking
+       to a keyframe doesn't go to the one before"""
+    return math.ceil(t * 1000) / 1000
+
+
+def make_smart_fragment(video, start, end, outfile, info):
+    """Cut fragment from `start` to `end` seconds frame-accurately:
+       re-encode video up to the first keyframe after `start` and copy
+       the rest. `info` is the probed video (see `probe.probe`)"""
+    encoder = probe.encoder(info)
+    if encoder is None or info.get("pix_fmt") is None:
+        ut.logger().warning(f"can't re-encode video, copy {outfile.name}")
+        return make_fragment(video, ut.to_hhmmss(start), ut.to_hhmmss(end),
+                             outfile)
+
+    keyframes = info["keyframes"]
+    i = bisect.bisect_left(keyframes, start - 0.001)
+    k = keyframes[i] if i < len(keyframes) else end
+    if k - start < 0.001:  # starts on keyframe
+        return make_fragment(video, ut.to_hhmmss(start), ut.to_hhmmss(end),
+                             outfile)
+
+    ut.logger().debug(f"smart cutting {outfile.resolve()}, re-encode"
+                      f" {min(k, end) - start:.3f} s")
+    encode = [
+        "-c:v", encoder, "-crf", "16", "-preset", "fast",
+        "-pix_fmt", info["pix_fmt"],
+    ]
+    ss, t = f"{start:.3f}", f"{end - start:.3f}"
+    if k >= end:  # no keyframes inside, re-encode everything
+        return _run([
+            "-ss", ss, "-i", f"{video}", "-t", t,
+            *encode, "-c:a", "copy", "-y", f"{outfile.resolve()}",
+        ])
+
+    tmpdir = outfile.with_name(f".{outfile.stem}.parts")
+    tmpdir.mkdir(exist_ok=True)
+    head, body = tmpdir/"head.mkv", tmpdir/"body.mkv"
+    parts = tmpdir/"parts.txt"
+    parts.write_text(f"file '{head.resolve().as_posix()}'\n"
+                     f"file '{body.resolve().as_posix()}'\n",
+                     encoding="utf-8")
+    try:
+        return _run([  # partial GOP at the start
+            "-ss", ss, "-i", f"{video}", "-t", f"{k - start:.3f}",
+            "-map", "0:v:0", *encode, "-an", "-y", f"{head}",
+        ]) and _run([  # whole GOPs up to the end
+            "-ss", f"{ceil_ms(k):.3f}", "-i", f"{video}",
+            "-t", f"{end - k:.3f}",
+            "-map", "0:v:0", "-c:v", "copy", "-an", "-y", f"{body}",
+        ]) and _run([  # join video and add audio
+            "-f", "concat", "-safe", "0", "-i", f"{parts}",
+            "-ss", ss, "-i", f"{video}", "-t", t,
+            "-map", "0:v", "-map", "1:a?", "-c", "copy",
+            "-y", f"{outfile.resolve()}",
+        ])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+Fragment = namedtuple("Fragment", ["start", "end", "outfile"])  # in seconds
+
+
+def snap(time, keyframes):
+    """Return keyframe time not later than `time`"""
+    if not keyframes:
+        return time
+    i = bisect.bisect_right(keyframes, time) - 1
+    return keyframes[max(i, 0)]
+
+
+def plan_passes(frags, max_gap=60, max_outputs=32):
+    """Split fragments `frags` into groups to cut in one pass each.
+       A group is a run of fragments sorted by start, which overlap
+       or are no more than `max_gap` seconds apart"""
+    groups = []
+    end = None
+    for f in sorted(frags):
+        if groups and f.start - end <= max_gap \
+           and len(groups[-1]) < max_outputs:
+            groups[-1].append(f)
+            end = max(end, f.end)
+        else:
+            groups.append([f])
+            end = f.end
+    return groups
+
+
+def make_fragments(video, frags, keyframes=None):
+    """Cut fragments `frags` of a group by one ffmpeg pass over `video`,
+       return dict of success flags by output file"""
+    ut.logger().debug(f"cutting {len(frags)} fragment(s) in one pass")
+    origin = snap(min(f.start for f in frags), keyframes)
+    args = [
+        f"{ffmpeg}",
+        "-ss", f"{origin:.3f}",
+        "-i", f"{video}",
+    ]
+    for f in frags:
+        s = snap(f.start, keyframes)  # decoded from it, but shown
+        args += [  # from `f.start` as `make_fragment` makes it
+            "-ss", f"{s - origin:.3f}",
+            "-to", f"{f.end - origin:.3f}",
+            "-output_ts_offset", f"{s - f.start:.3f}",
+            "-c:v", "copy", "-c:a", "copy",
+            "-y", f"{f.outfile.resolve()}",
+        ]
+    p = ut.run_process(args)
+    if not p.returncode:
+        return {f.outfile: True for f in frags}
+
+    ut.logger().error(ut.decode(p.stderr))
+    if len(frags) == 1:
+        return {frags[0].outfile: False}
+    ut.logger().debug("cut the group one by one")  # to isolate failures
+    return {f.outfile: make_fragment(video, ut.to_hhmmss(f.start),
+                                     ut.to_hhmmss(f.end), f.outfile)
+            for f in frags}
+
+
+class Batch:
+    """Cut fragments in groups by one ffmpeg pass per group (see
+       `plan_passes`). A group is cut on the first request of any
+       of its fragments, so it may be used from several threads"""
+
+    def __init__(self, video, frags, keyframes=None, **kwargs):
+        self.video, self.keyframes = video, keyframes
+        self.groups = plan_passes(frags, **kwargs)
+        self.group_of = {f.outfile: i
+                         for i, g in enumerate(self.groups) for f in g}
+        self.results = {}
+        self.lock = threading.Lock()
+        ut.logger().debug(f"{len(frags)} fragment(s) in"
+                          f" {len(self.groups)} pass(es)")
+
+    def make_fragment(self, outfile):
+        """Return true if fragment `outfile` is cut successfully"""
+        i = self.group_of[outfile]
+        with self.lock:
+            owner = i not in self.results
+            if owner:
+                self.results[i] = futures.Future()
+            result = self.results[i]
+        if owner:
+            try:
+                result.set_result(make_fragments(self.video, self.groups[i],
+                                                 self.keyframes))
+            except BaseException as e:
+                result.set_exception(e)
+        return result.result()[outfile]
+
+
+# ffmpeg arguments of transcode profiles by name: "video" ones are used
+# for every chunk of a fragment, "audio" ones for its whole audio track
+PROFILES = {
+    "h264": {
+        "video": ["-c:v", "libx264", "-crf", "20", "-preset", "medium",
+                  "-pix_fmt", "yuv420p"],
+        "audio": ["-c:a", "aac", "-b:a", "160k"],
+    },
+    "social": {  # up to 1080p with loudness normalized
+        "video": ["-vf", "scale=-2:'min(1080,ih)'", "-c:v", "libx264",
+                  "-crf", "23", "-preset", "medium", "-pix_fmt", "yuv420p",
+                  "-maxrate", "8M", "-bufsize", "16M"],
+        "audio": ["-af", "loudnorm=I=-14:TP=-1:LRA=11", "-c:a", "aac",
+                  "-b:a", "128k", "-ar", "48000"],
+    },
+}
+
+
+def split_chunks(start, end, chunk, keyframes=None):
+    """Return bounds of chunks about `chunk` seconds long from `start`
+       to `end` seconds, inner ones are moved to the nearest keyframe
+       if there is one close enough"""
+    bounds = [start]
+    while end - bounds[-1] > 1.5 * chunk:
+        t = bounds[-1] + chunk
+        if keyframes:
+            i = bisect.bisect_left(keyframes, t)
+            near = [k for k in keyframes[max(i - 1, 0):i + 1]
+                    if bounds[-1] + chunk / 2 <= k <= end - chunk / 2]
+            if near:
+                t = min(near, key=lambda k: abs(k - t))
+        bounds.append(t)
+    bounds.append(end)
+    return bounds
+
+
+def _encode(args):
+    """Run ffmpeg with `args`, return success flag and its CPU time"""
+    cpu = ut.cpu_time()
+    ok = _run(args)
+    return ok, ut.cpu_time() - cpu
+
+
+class Transcoder:
+    """Re-encode fragments by transcode `profile` (name from `PROFILES`
+       or dict like them) running up to `workers` ffmpeg processes at once
+       for all fragments. A fragment longer than `chunk` seconds is split
+       into chunks at keyframes (see `split_chunks`), which are encoded
+       in parallel and joined without re-encoding, a shorter one is
+       encoded whole. Audio is encoded by the join, so its filters see
+       the whole fragment. Every ffmpeg process is run holding a context
+       manager made by `slot()` if given, a slot of global limits for
+       one. It may be used from several threads"""
+
+    def __init__(self, profile, keyframes=None, workers=None, chunk=30,
+                 slot=None):
+        name = profile if isinstance(profile, str) else "custom"
+        if isinstance(profile, str):
+            if profile not in PROFILES:
+                raise RuntimeError(f"unknown transcode profile '{profile}'")
+            profile = PROFILES[profile]
+        self.video = profile.get("video") or []
+        self.audio = profile.get("audio") or ["-c:a", "copy"]
+        s = json.dumps([self.video, self.audio])
+        self.id = f"{name} {hashlib.sha1(s.encode('utf-8')).hexdigest()[:8]}"
+        self.keyframes, self.chunk = keyframes, chunk
+        workers = workers or os.cpu_count()
+        # encoder threads of a process, so all of them share the cores
+        self.threads = f"{max(os.cpu_count() // workers, 1)}"
+        self.pool = futures.ThreadPoolExecutor(workers, "encode")
+        self.slot = slot or contextlib.nullcontext
+
+    def _encode(self, args):
+        with self.slot():
+            return _encode(args)
+
+    def make_fragment(self, video, start, end, outfile):
+        """Return true if fragment from `start` to `end` seconds
+           is encoded into `outfile` successfully"""
+        bounds = split_chunks(start, end, self.chunk, self.keyframes)
+        ss, t = f"{start:.6f}", f"{end - start:.6f}"
+        if len(bounds) == 2:
+            ut.logger().debug(f"transcoding {outfile.resolve()}")
+            ok, cpu = self.pool.submit(self._encode, [
+                "-ss", ss, "-i", f"{video}", "-t", t,
+                "-map", "0:v:0", "-map", "0:a?",
+                *self.video, "-threads", self.threads, *self.audio,
+                "-y", f"{outfile.resolve()}",
+            ]).result()
+            ut.count_cpu(cpu)
+            return ok
+
+        ut.logger().debug(f"transcoding {outfile.resolve()}"
+                          f" in {len(bounds) - 1} chunks")
+        tmpdir = outfile.with_name(f".{outfile.stem}.chunks")
+        tmpdir.mkdir(exist_ok=True)
+        chunks = [tmpdir/f"{i:04d}.mkv" for i in range(len(bounds) - 1)]
+        parts = tmpdir/"parts.txt"
+        parts.write_text("".join(f"file '{c.resolve().as_posix()}'\n"
+                                 for c in chunks), encoding="utf-8")
+        try:
+            jobs = [self.pool.submit(self._encode, [
+                "-ss", f"{s:.6f}", "-i", f"{video}", "-t", f"{e - s:.6f}",
+                "-map", "0:v:0", *self.video, "-threads", self.threads,
+                "-an", "-y", f"{c}",
+            ]) for s, e, c in zip(bounds, bounds[1:], chunks)]
+            results = [j.result() for j in jobs]
+            ut.count_cpu(sum(cpu for _, cpu in results))
+            if not all(ok for ok, _ in results):
+                return False
+            with self.slot():
+                return _run([
+                    "-f", "concat", "-safe", "0", "-i", f"{parts}",
+                    "-ss", ss, "-i", f"{video}", "-t", t,
+                    "-map", "0:v", "-map", "1:a?", "-c:v", "copy",
+                    *self.audio, "-y", f"{outfile.resolve()}",
+                ])
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from concurrent import futures
+
+import requests
+
+import mp4index
+import utils as ut
+
+
+DOWNLOAD_URL = "https://www.googleapis.com/drive/v3/files/{id}"
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+def parts_file(target):
+    """Return sidecar file to keep downloaded segments of `target`"""
+    return target.with_name(f"{target.name}.parts")
+
+
+def verified_file(target):
+    """Return sidecar file to keep verified MD5 checksum of `target`"""
+    return target.with_name(f"{target.name}.md5")
+
+
+def _stamp(target):
+    st = target.stat()
+    return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def verified_md5(target):
+    """Return MD5 checksum `target` is verified to have,
+       or None if it isn't or it is changed since"""
+    file = verified_file(target)
+    if not file.exists() or not target.exists():
+        return None
+    with file.open("r", encoding="utf-8") as f:
+        data = json.load(f)
+    md5 = data.pop("md5", None)
+    return md5 if data == _stamp(target) else None
+
+
+def is_verified(target, md5):
+    """Return true if `target` is verified to have `md5` checksum
+       and is not changed since"""
+    return md5 is not None and verified_md5(target) == md5
+
+
+def record_verified(target, md5):
+    file = verified_file(target)
+    tmp = file.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump({"md5": md5, **_stamp(target)}, f)
+    os.replace(tmp, file)
+
+
+def verify(target, md5):
+    """Check `target` has `md5` checksum reading it whole,
+       record it if so (see `is_verified`)"""
+    h = hashlib.md5()
+    with target.open("rb") as f:
+        while chunk := f.read(1024*1024):
+            h.update(chunk)
+    if h.hexdigest() != md5:
+        ut.logger().warning(f"'{target.name}' has wrong checksum")
+        return False
+    record_verified(target, md5)
+    return True
+
+
+class Digest:
+    """MD5 checksum of the completed beginning of a download.
+
+       Segments are done in any order, so it is advanced over the run of
+       completed ones from the beginning each time a segment is done,
+       reading them back while they are still in the OS cache"""
+
+    def __init__(self, target, segments):
+        self.target, self.segments = target, segments
+        self.h = hashlib.md5()
+        self.next = 0  # the first segment not hashed
+
+    def advance(self, done):
+        """Hash segments from the next one while they are in `done`"""
+        if self.next >= len(self.segments) or self.next not in done:
+            return
+        with self.target.open("rb") as f:
+            while self.next < len(self.segments) and self.next in done:
+                a, b = self.segments[self.next]
+                f.seek(a)
+                while a < b:
+                    chunk = f.read(min(b - a, 1024*1024))
+                    if not chunk:
+                        raise DownloadError(f"'{self.target.name}'"
+                                            " is truncated")
+                    self.h.update(chunk)
+                    a += len(chunk)
+                self.next += 1
+
+    def complete(self):
+        return self.next == len(self.segments)
+
+    def hexdigest(self):
+        return self.h.hexdigest()
+
+
+class Parts:
+    """Completed segments of a download saved in JSON `file`"""
+
+    def __init__(self, file, size, segment_size):
+        self.file = file
+        self.lock = threading.Lock()
+        self.done = set()
+        self.size, self.segment_size = size, segment_size
+        if file.exists():
+            with file.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if (data["size"], data["segment_size"]) == (size, segment_size):
+                self.done = set(data["done"])
+
+    def add(self, i):
+        with self.lock:
+            self.done.add(i)
+            tmp = self.file.with_suffix(".tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump({
+                    "size": self.size,
+                    "segment_size": self.segment_size,
+                    "done": sorted(self.done),
+                }, f)
+            os.replace(tmp, self.file)
+
+    def remove(self):
+        self.file.unlink(missing_ok=True)
+
+
+class Downloader:
+    """Download Google Drive files by several concurrent HTTP Range requests.
+
+       `session` is an authorized `requests.Session`. The file is split into
+       segments of `segment_size` bytes fetched by `workers` threads into
+       a preallocated target. Completed segments are recorded in a sidecar
+       file (see `parts_file`), so an interrupted download is resumed"""
+
+    def __init__(self, session, workers=4, segment_size=64*1024*1024,
+                 retries=5, url=DOWNLOAD_URL):
+        self.session = session
+        self.workers = max(workers, 1)
+        self.segment_size = max(segment_size, 1024*1024)
+        self.retries = retries
+        self.url = url
+
+    def segments(self, size):
+        return [(a, min(a + self.segment_size, size))
+                for a in range(0, size, self.segment_size)]
+
+    def covering(self, ranges):
+        """Return indices of segments covering byte `ranges`"""
+        return {i for a, b in ranges if b > a
+                for i in range(a // self.segment_size,
+                               (b - 1) // self.segment_size + 1)}
+
+    def resumed(self, target, size, only=None):
+        """Return number of bytes of `target` downloaded before,
+           counting only segments from `only` if given"""
+        parts = Parts(parts_file(target), size, self.segment_size)
+        if not target.exists() or target.stat().st_size != size:
+            return 0
+        segs = self.segments(size)
+        return sum(segs[i][1] - segs[i][0] for i in parts.done
+                   if only is None or i in only)
+
+    def needed(self, size, only=None):
+        """Return number of bytes to download in segments `only`"""
+        segs = self.segments(size)
+        return sum(b - a for i, (a, b) in enumerate(segs)
+                   if only is None or i in only)
+
+    def download(self, id, target, size, callback=None, only=None,
+                 md5=None):
+        """Download file with `id` and `size` bytes to `target`,
+           `callback(n)` is called for every `n` bytes received.
+           If set of segment indices `only` is given, the rest of
+           the file is left unfilled. If `md5` checksum is given,
+           the whole file is checked while downloading and recorded
+           as verified (see `is_verified`)"""
+        parts = Parts(parts_file(target), size, self.segment_size)
+        if not target.exists() or target.stat().st_size != size:
+            parts.done.clear()
+            with target.open("wb") as f:
+                f.truncate(size)  # preallocate (sparse if supported)
+        verified_file(target).unlink(missing_ok=True)
+
+        lock = threading.Lock()
+
+        def progress(n):
+            if callback is not None:
+                with lock:
+                    callback(n)
+
+        segs = self.segments(size)
+        digest = None
+        if md5 is not None and only is None:
+            digest = Digest(target, segs)
+            digest.advance(parts.done)  # done by the previous runs
+        todo = [(i, seg) for i, seg in enumerate(segs)
+                if i not in parts.done and (only is None or i in only)]
+        ut.logger().debug(f"download {len(todo)} segment(s)"
+                          f" by {self.workers} worker(s)")
+        if todo:
+            with futures.ThreadPoolExecutor(self.workers) as pool:
+                jobs = {pool.submit(self._fetch, id, target, *seg,
+                                    progress): i
+                        for i, seg in todo}
+                for job in futures.as_completed(jobs):
+                    job.result()
+                    parts.add(jobs[job])
+                    if digest is not None:
+                        digest.advance(parts.done)
+        if digest is not None and digest.complete():
+            if digest.hexdigest() != md5:
+                parts.remove()  # all to be downloaded again
+                target.unlink(missing_ok=True)  # not to be hashed again
+                raise DownloadError(f"'{target.name}' has checksum"
+                                    f" {digest.hexdigest()}, not {md5}")
+            record_verified(target, md5)
+        if len(parts.done) == len(segs):
+            parts.remove()
+
+    def partial(self, id, target, size, spans):
+        """Return segments of MP4 file needed to cut time `spans`,
+           a list of (start, end) in seconds. The file index
+           is downloaded to `target` while reading"""
+        def read(offset, n):
+            n = min(n, size - offset)
+            self.download(id, target, size,
+                          only=self.covering([(offset, offset + n)]))
+            with target.open("rb") as f:
+                f.seek(offset)
+                return f.read(n)
+
+        index = mp4index.Index(read, size)
+        return self.covering(index.byte_ranges(spans))
+
+    def _fetch(self, id, target, start, end, progress):
+        """Fetch bytes [start, end) of file `id` into `target`"""
+        offset, attempt = start, 0
+        with target.open("r+b") as f:
+            while offset < end:
+                try:
+                    r = self.session.get(
+                        self.url.format(id=id),
+                        params={"alt": "media"},
+                        headers={"Range": f"bytes={offset}-{end - 1}"},
+                        stream=True,
+                    )
+                    if r.status_code != 206:
+                        raise DownloadError(f"unexpected response"
+                                            f" ({r.status_code} {r.text})")
+                    f.seek(offset)
+                    for chunk in r.iter_content(chunk_size=1024*1024):
+                        chunk = chunk[:end - offset]
+                        f.write(chunk)
+                        offset += len(chunk)
+                        progress(len(chunk))
+                        if offset >= end:
+                            break
+                    r.close()
+                except (requests.RequestException, DownloadError) as e:
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+                    ut.logger().warning(f"segment {start}-{end} failed"
+                                        f" at {offset}, retry: {e}")
+                    time.sleep(min(2**attempt, 64))
+            f.flush()
+            os.fsync(f.fileno())  # before the segment is recorded as done
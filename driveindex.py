@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+
+import utils as ut
+
+
+API_URL = "https://www.googleapis.com/drive/v3"
+FILE_FIELDS = ("id,name,mimeType,size,md5Checksum,parents,trashed,"
+               "appProperties")
+
+
+class DriveIndexError(RuntimeError):
+    pass
+
+
+class FolderIndex:
+    """Local index of video files in Google Drive folder `id`.
+
+       The index is kept in JSON `file` with the name, size, MD5
+       checksum and fragment key (app property "key", see `lookup`)
+       of every file. It is filled by a full listing once and
+       then refreshed by the Drive changes feed, so only the files
+       changed since the previous run are fetched"""
+
+    def __init__(self, session, id, file, url=API_URL):
+        self.session, self.id, self.file, self.url = session, id, file, url
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()  # it may be shared by jobs
+        self.token = None
+        self.files = {}
+        self.names = {}  # file IDs by name
+        if file.exists():
+            with file.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("folder") == id:
+                self.token = data["token"]
+                for fid, entry in data["files"].items():
+                    self._add(fid, entry)
+
+    def refresh(self):
+        """Bring the index up to date with the folder"""
+        with self.refreshing:
+            if self.token is None:
+                self._list()
+            else:
+                self._changes()
+            self.save()
+        ut.logger().debug(f"{len(self.files)} video(s) in folder {self.id}")
+        return self
+
+    def _get(self, path, params):
+        r = self.session.get(f"{self.url}/{path}", params=params)
+        if r.status_code != 200:
+            raise DriveIndexError(f"failed to get '{path}'"
+                                  f" ({r.status_code} {r.text})")
+        return r.json()
+
+    def _list(self):
+        self.token = self._get("changes/startPageToken",
+                               {})["startPageToken"]  # before listing
+        self.files, self.names = {}, {}
+        params = {
+            "q": f"'{self.id}' in parents and trashed=false"
+                 " and mimeType contains 'video'",
+            "fields": f"nextPageToken,files({FILE_FIELDS})",
+            "pageSize": 1000,
+        }
+        while True:
+            data = self._get("files", params)
+            for file in data.get("files", []):
+                self.update(file)
+            if (page := data.get("nextPageToken")) is None:
+                break
+            params["pageToken"] = page
+
+    def _changes(self):
+        params = {
+            "pageToken": self.token,
+            "fields": "nextPageToken,newStartPageToken,"
+                      f"changes(fileId,removed,file({FILE_FIELDS}))",
+            "includeRemoved": "true",
+            "pageSize": 1000,
+        }
+        n = 0
+        while True:
+            data = self._get("changes", params)
+            for change in data.get("changes", []):
+                n += 1
+                if change.get("removed"):
+                    self.remove(change["fileId"])
+                else:
+                    self.update(change["file"])
+            if (token := data.get("newStartPageToken")) is not None:
+                self.token = token
+                break
+            params["pageToken"] = data["nextPageToken"]
+        ut.logger().debug(f"{n} change(s) since the previous refresh")
+
+    def update(self, file):
+        """Add or update Drive `file` resource if it is a video
+           in the folder, remove it otherwise"""
+        if file.get("trashed") or self.id not in file.get("parents", []) \
+           or not file.get("mimeType", "").startswith("video"):
+            self.remove(file["id"])
+            return
+        self.remove(file["id"])  # it may be renamed
+        with self.lock:
+            self._add(file["id"], {
+                "name": file["name"],
+                "mimeType": file["mimeType"],
+                "size": int(file.get("size", 0)),
+                "md5Checksum": file.get("md5Checksum"),
+                "key": (file.get("appProperties") or {}).get("key"),
+            })
+
+    def _add(self, id, file):
+        self.files[id] = file
+        self.names.setdefault(file["name"], set()).add(id)
+
+    def remove(self, id):
+        with self.lock:
+            if (file := self.files.pop(id, None)) is not None:
+                self.names[file["name"]].discard(id)
+
+    def save(self):
+        with self.lock:
+            tmp = self.file.with_suffix(".tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump({
+                    "folder": self.id,
+                    "token": self.token,
+                    "files": self.files,
+                }, f, ensure_ascii=False)
+            os.replace(tmp, self.file)
+
+    def lookup(self, name, md5=None, key=None):
+        """Return file by `name` or None. If `md5` is given,
+           the file must have the same checksum, if `key` is,
+           it must be uploaded with the same app property `key`"""
+        with self.lock:
+            for id in self.names.get(name, ()):
+                file = self.files[id]
+                if (md5 is None or file["md5Checksum"] == md5) \
+                   and (key is None or file.get("key") == key):
+                    return {"id": id, **file}
+        return None
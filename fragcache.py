@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import threading
+
+import utils as ut
+
+
+class Manifest:
+    """Cache of fragments cut in directory `dir`.
+
+       Every fragment is recorded in `manifest.json` with a key made of
+       the `source` checksum, the effective start/end times and the way
+       it was cut (see `key`). A fragment is valid if it is recorded with
+       the same key and size, so a changed margin or a file truncated by
+       a crashed ffmpeg run is cut again. Fragments without a local file
+       (streamed to Drive or evicted) keep their MD5 checksum to be found
+       on Drive (see `md5`), but aren't valid to be uploaded again"""
+
+    def __init__(self, dir, source):
+        self.dir, self.source = dir, source
+        self.file = dir/"manifest.json"
+        self.lock = threading.Lock()
+        self.data = {}
+        if self.file.exists():
+            with self.file.open("r", encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def key(self, start, end, method):
+        """Return key of fragment from `start` to `end` seconds
+           cut by `method` (ffmpeg arguments or their summary)"""
+        s = json.dumps([self.source, start, end, method])
+        return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+    def valid(self, outfile, key):
+        """Return true if `outfile` is cut before with the same `key`"""
+        with self.lock:
+            entry = self.data.get(outfile.name)
+        if entry is None or entry["key"] != key \
+           or not entry.get("local", True):
+            return False
+        try:
+            return outfile.stat().st_size == entry["size"]
+        except FileNotFoundError:
+            return False
+
+    def md5(self, outfile, key):
+        """Return MD5 checksum of `outfile` if it is cut with `key`"""
+        with self.lock:
+            entry = self.data.get(outfile.name)
+        if entry is None or entry["key"] != key:
+            return None
+        if entry.get("local", True) and not self.valid(outfile, key):
+            return None
+        return entry.get("md5")
+
+    @staticmethod
+    def temp(outfile):
+        """Return temporary file to cut `outfile` into"""
+        return outfile.with_name(f".{outfile.stem}.part{outfile.suffix}")
+
+    def commit(self, outfile, key):
+        """Move temporary file of `outfile` in place and record it"""
+        os.replace(self.temp(outfile), outfile)
+        h = hashlib.md5()
+        with outfile.open("rb") as f:  # just written, so cached by OS
+            while chunk := f.read(1024*1024):
+                h.update(chunk)
+        with self.lock:
+            self.data[outfile.name] = {
+                "key": key,
+                "size": outfile.stat().st_size,
+                "md5": h.hexdigest(),
+            }
+            self._save()
+        ut.logger().debug(f"cached {outfile.name} ({key})")
+
+    def record(self, outfile, key, size, md5):
+        """Record `outfile` streamed to Drive without a local file"""
+        with self.lock:
+            self.data[outfile.name] = {
+                "key": key,
+                "size": size,
+                "md5": md5,
+                "local": False,
+            }
+            self._save()
+
+    def evicted(self, outfile):
+        """Record that local file of `outfile` is removed"""
+        with self.lock:
+            if (entry := self.data.get(outfile.name)) is not None:
+                entry["local"] = False
+                self._save()
+
+    def _save(self):
+        tmp = self.file.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(tmp, self.file)
+
+    def discard(self, outfile):
+        self.temp(outfile).unlink(missing_ok=True)
@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 
-import gspread
+import json
+import os
 import pathvalidate as pv
 import re
-import tqdm
 
 from collections import namedtuple
-from pydrive2.files import ApiRequestError, FileNotUploadedError
 from urllib.parse import urlparse
 
 import utils as ut
 
+# Google clients, requests and the modules using them are imported
+# on first use, so the tool starts fast if it doesn't go online
+
 
 _credentials = None
 _gd = None
 _gc = None
+_session = None
 
 
 def get_credentials(auth_token):
@@ -60,11 +63,26 @@ def get_sheet(auth_token):
     if _gc is not None:
         return _gc
 
+    import gspread
+    import ratelimit
     credentials = get_credentials(auth_token)
     _gc = gspread.authorize(credentials)
+    ratelimit.mount(_gc.http_client.session)
     return _gc
 
 
+def get_session(auth_token):
+    """Return authorized HTTP session by `auth_token` for Google APIs"""
+    global _session
+    if _session is not None:
+        return _session
+
+    from google.auth.transport.requests import AuthorizedSession
+    import ratelimit
+    _session = ratelimit.mount(AuthorizedSession(get_credentials(auth_token)))
+    return _session
+
+
 _gid_pat = re.compile(r"[-\w]{25,}")
 
 
@@ -87,7 +105,9 @@ def is_video(file):
 
 def is_folder(id):
     """Return true if Google disk resource with `id` is folder"""
+    import ratelimit
     r = _gd.CreateFile({"id": id})
+    ratelimit.call("drive", r.FetchMetadata)
     return r["mimeType"].endswith("folder")
 
 
@@ -99,51 +119,106 @@ def get_meta(file):
     return mime, title, size
 
 
+def get_checksum(id):
+    """Return MD5 checksum of Google Drive file with `id` if any"""
+    import ratelimit
+    file = _gd.CreateFile({"id": id})
+    ratelimit.call("drive", lambda: file.FetchMetadata(fields="md5Checksum"))
+    return file.get("md5Checksum")
+
+
 def meta_str(mime, title, size):
     return f"{ut.humansize(size)} {mime} - {title}"
 
 
-def download_video(id, path, indent=""):
-    """Access a Google Drive file and download it on disk at path location"""
+def download_video(id, path, workers=4, spans=None, cache=None,
+                   progress=None, room=None):
+    """Access a Google Drive file and download it on disk at path location.
+       If time `spans` are given, download only parts of MP4 file needed
+       to cut them, the rest of the file is left unfilled. If shared
+       `cache` (see `sharedcache.SourceCache`) is given, the whole file
+       is downloaded there instead, unless it is already. `progress(done,
+       total)` is called with bytes downloaded as the progress bar goes,
+       `room(target, size)` before the file of `size` bytes is downloaded
+       to local `target`. Return the file and number of bytes downloaded"""
+    import ratelimit
     ut.logger().debug(f"resource id is '{id}'")
     file = _gd.CreateFile({"id": id})
+    ratelimit.call("drive", file.FetchMetadata)
     if not is_video(file):
         raise RuntimeError("not a video file (id={id})")
 
     mime, title, size = get_meta(file)
     print('>', meta_str(mime, title, size))
-    target = path / pv.sanitize_filename(title)
-    if not target.exists() or size != target.stat().st_size:
-        ut.logger().debug(f"{ut.humansize(size)} {mime} - '{title}'")
+    name = pv.sanitize_filename(title)
+    md5 = file.get("md5Checksum")
+    if cache is not None and md5 is not None:
+        n_bytes = []
+        target = cache.get(id, md5, name, lambda part: n_bytes.append(
+            fetch_video(id, part, size, workers, md5=md5,
+                        progress=progress)))
+        return target, sum(n_bytes)
+    target = path / name
+    if room is not None:
+        room(target, size)
+    return target, fetch_video(id, target, size, workers, spans, md5,
+                               progress)
+
+
+def is_fetched(target, size, md5=None):
+    """Return true if `target` is downloaded whole and, if `md5` is
+       given, has that checksum. A file not verified before is checked
+       once and recorded (see `download.is_verified`)"""
+    import download
+    if not target.exists() or size != target.stat().st_size \
+       or download.parts_file(target).exists():
+        return False
+    return md5 is None or download.is_verified(target, md5) \
+        or download.verify(target, md5)
+
+
+def fetch_video(id, target, size, workers=4, spans=None, md5=None,
+                progress=None):
+    """Download Google Drive file `id` of `size` bytes to `target` unless
+       it is already, return number of bytes downloaded. See `spans` and
+       `progress` in `download_video`, the whole file is checked
+       to have `md5`"""
+    import download
+    import mp4index
+    import requests
+    import tqdm
+    n_bytes = 0
+    if not is_fetched(target, size, md5):
+        ut.logger().debug(f"{ut.humansize(size)} - '{target.name}'")
         ut.logger().debug("downloading...")
         try:
-            progress_bar = tqdm.tqdm(total=size, unit='B', unit_scale=True)
-
-            def download_progress(current_size, total_size):
-                progress_bar.update(current_size - progress_bar.n)
-
-            file.GetContentFile(target.as_posix(), callback=download_progress)
+            loader = download.Downloader(_session, workers=workers)
+            only = None
+            if spans is not None:
+                try:
+                    only = loader.partial(id, target, size, spans)
+                except mp4index.FormatError as e:
+                    ut.logger().warning(f"download whole file, '{e}'")
+            progress_bar = tqdm.tqdm(total=loader.needed(size, only),
+                                     initial=loader.resumed(target, size,
+                                                            only),
+                                     unit='B', unit_scale=True)
+
+            def update(n):
+                progress_bar.update(n)
+                if progress is not None:
+                    progress(progress_bar.n, progress_bar.total)
+
+            loader.download(id, target, size, update, only, md5)
+            n_bytes = progress_bar.n - progress_bar.initial
             progress_bar.close()
-        except (ApiRequestError, FileNotUploadedError) as e:
-            ut.logger().exception(f"failed to download file '{title}', '{e}'")
+        except (requests.RequestException, download.DownloadError) as e:
+            ut.logger().exception(f"failed to download file"
+                                  f" '{target.name}', '{e}'")
             raise
     else:
         ut.logger().debug("skip")
-    return target
-
-
-def list_videos(id):
-    """Return video files list of Google Drive folder with `id`"""
-    videos = {}
-    query = f"'{id}' in parents and trashed=false" \
-            " and mimeType contains 'video'"
-    for file in _gd.ListFile({'q': query}).GetList():
-        title = file["title"]
-        ut.logger().debug(f"try file '{title}'")
-        size = int(file["fileSize"])
-        ut.logger().debug(f"file size '{size}'")
-        videos.update({f"{title}": file})
-    return videos
+    return n_bytes
 
 
 _gid_frag_pat = re.compile(r"gid=([\d]+)")
@@ -193,11 +268,38 @@ def column_index(header, cols):
     return idx
 
 
-def load_table(worksheet, ihead, n_head_rows):
-    vals = worksheet.get_all_values()
-    header = vals[ihead-1]
-    rows = vals[n_head_rows:]
-    return header, rows
+def column_letter(i):
+    """Return A1 notation letter of column with zero-based index `i`"""
+    letter = ""
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        letter = chr(ord("A") + r) + letter
+    return letter
+
+
+def load_table(worksheet, ihead, n_head_rows, cols, idx=None):
+    """Return column index, header and rows of worksheet with only
+       columns `cols`, fetched by one batch request. Column index `idx`
+       is taken from the header row if not given or outdated"""
+    if idx is None:
+        idx = column_index(worksheet.row_values(ihead), cols)
+    ranges = []
+    for j in idx:
+        c = column_letter(j)
+        ranges += [f"{c}{ihead}", f"{c}{n_head_rows+1}:{c}"]
+    vals = worksheet.batch_get(ranges, major_dimension="COLUMNS")
+    vals = [v[0] if v else [] for v in vals]
+
+    header = [v[0] if v else "" for v in vals[::2]]
+    if clean_whitespace(header) != clean_whitespace(cols):
+        ut.logger().debug("columns have been moved")
+        return load_table(worksheet, ihead, n_head_rows, cols)
+
+    columns = vals[1::2]
+    n = max(len(c) for c in columns)
+    rows = [[c[i] if i < len(c) else "" for c in columns] for i in range(n)]
+    return idx, header, rows
 
 
 def filter_rows(header, rows, cols):
@@ -208,9 +310,13 @@ def filter_rows(header, rows, cols):
     return rows
 
 
-def extract_timing(wsht, ihead, n_head_rows, cols):
-    header, rows = load_table(wsht, ihead, n_head_rows)
-    rows = filter_rows(header, rows, cols)
+def extract_timing(wsht, ihead, n_head_rows, cols, idx=None):
+    idx, header, rows = load_table(wsht, ihead, n_head_rows, cols, idx)
+    return idx, make_timing(filter_rows(header, rows, cols), n_head_rows)
+
+
+def make_timing(rows, n_head_rows):
+    """Return time codes of valid checked `rows` (see `filter_rows`)"""
     tm_codes = []
     for r in rows:
         s, e, name = r.start, r.end, r.name
@@ -224,3 +330,44 @@ def extract_timing(wsht, ihead, n_head_rows, cols):
                                    ut.to_hhmmss(e),
                                    name))
     return tm_codes
+
+
+def get_version(id):
+    """Return version of Google Drive file with `id`,
+       which is changed on every change of the file"""
+    import ratelimit
+    file = _gd.CreateFile({"id": id})
+    ratelimit.call("drive", lambda: file.FetchMetadata(fields="version"))
+    return file["version"]
+
+
+def load_timing(gc, url, ihead, n_head_rows, cols, cache):
+    """Return time codes from worksheet by `url` using client `gc`.
+       They are kept in JSON file `cache` until the spreadsheet is
+       changed, so an unchanged one costs a single metadata request"""
+    key = [url, ihead, n_head_rows, list(cols)]
+    version = get_version(as_id(url))
+    data = {}
+    if cache.exists():
+        with cache.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("key") == key and data.get("version") == version:
+            ut.logger().debug(f"worksheet is not changed ({version})")
+            return [TmCode(*tm) for tm in data["tm_codes"]]
+
+    idx = None  # try the previous columns
+    if data.get("key") == key:
+        idx = TabColumns(*data["idx"])
+    wsht = open_worksheet(gc, url)
+    idx, tm_codes = extract_timing(wsht, ihead, n_head_rows, cols, idx)
+
+    tmp = cache.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump({
+            "key": key,
+            "version": version,
+            "idx": idx,
+            "tm_codes": tm_codes,
+        }, f, ensure_ascii=False)
+    os.replace(tmp, cache)
+    return tm_codes
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import pathlib
+import tempfile
+
+import requests
+
+import cut
+import download
+import driveindex
+import fragcache
+import google_serve as gs
+import journal
+import localstore
+import orchestrator
+import pipeline
+import probe
+import scheduler
+import sharedcache
+import upload
+import utils as ut
+
+
+class Job:
+    """Cutting job described by settings `args` (see config.sample.json).
+
+       Keeps the Google clients, the source video, the output folder
+       index and the fragment cache between runs, so it may be run
+       again and again for new time codes"""
+
+    def __init__(self, args, limits=None):
+        self.args = args
+        self.name = args.get("name")  # set for jobs of a batch
+        self.limits = limits or scheduler.Limits()
+        self.tempdir = pathlib.Path(args["temporary_dir"])
+        ut.logger().debug(f"create temporary dir '{self.tempdir.resolve()}'")
+        self.tempdir.mkdir(parents=True, exist_ok=True)
+        self.fragdir = self.tempdir/"fragments"
+        self.fragdir.mkdir(exist_ok=True)
+        self.store = localstore.LocalStore(
+            self.tempdir/"store.json",
+            int((args.get("disk_quota") or 0) * 1024**3), self.evicted)
+
+        self.video = None
+        self.cache = None  # shared by processes
+        if args.get("source_cache"):
+            self.cache = sharedcache.SourceCache(args["source_cache"])
+        self.folder = None
+        self.journal = journal.Journal(self.tempdir/"journal.jsonl")
+        self.manifest = None
+        self.probed = None
+        self.transcoder = None
+        self.method = "copy"
+        self.stat = ut.Statistics()  # replaced by the one of `run`
+        self.workers = args.get("workers") or os.cpu_count()
+        self.upload_workers = args.get("upload_workers") or 2
+        self.queue_size = args.get("queue_size") or 2*self.workers
+        self.connect()
+
+    def connect(self):
+        """Authorize Google clients and find Drive files of the job"""
+        args = self.args
+        self.auth_token = ut.checked_path(args["auth_token"])
+        gs.get_drive(self.auth_token)
+        gs.get_session(self.auth_token)
+        self.video_id = gs.as_id(args["video_url"])
+        self.outdir_id = gs.as_id(args["output_dir_url"])
+        self.uploader = upload.Uploader(
+            gs.get_session(self.auth_token),
+            upload.Sessions(self.tempdir/"uploads.json"),
+            chunk_size=int(args.get("chunk_size", 8) * 1024*1024),
+        )
+
+    def load_timing(self):
+        """Return time codes from the worksheet"""
+        args = self.args
+        return gs.load_timing(gs.get_sheet(self.auth_token),
+                              args["worksheet_url"],
+                              args["head_row"],
+                              args["n_head_rows"],
+                              gs.TabColumns(
+                                 args["columns"]["slice"],
+                                 args["columns"]["start"],
+                                 args["columns"]["end"],
+                                 args["columns"]["name"],
+                              ),
+                              self.tempdir/"worksheet.json")
+
+    def journal_key(self):
+        """Return settings which make the time codes of a run,
+           so an interrupted run is resumed only by the same job"""
+        args = self.args
+        return json.loads(json.dumps([
+            args.get("video_url"), args.get("worksheet_url"),
+            args.get("output_dir_url"), args["head_row"],
+            args["n_head_rows"], args["columns"], args["correct"],
+            args["do_upload"],
+        ]))  # as it is read back
+
+    def plan(self, stat):
+        """Return time codes to process: the rest of the interrupted
+           run if any, or all of the worksheet"""
+        done_event = journal.UPLOADED if self.args["do_upload"] \
+            else journal.CUT
+        key = self.journal_key()
+        if (state := self.journal.resume(done_event, key)) is not None:
+            tm_codes, done = state
+            self.report([f"Resume the interrupted run, {len(done)} of"
+                         f" {len(done) + len(tm_codes)} time code(s)"
+                         " are done"])
+            stat.total += len(done)
+            stat.ready += len(done)
+            return tm_codes
+        with stat.span("sheet", job=self.name):
+            tm_codes = self.load_timing()
+        self.journal.start(tm_codes, key)
+        return tm_codes
+
+    def span(self, tm):
+        """Return start and end of fragment in seconds with correction"""
+        s = ut.to_seconds(tm.start) + self.args["correct"]["start_time"]
+        e = ut.to_seconds(tm.end) + self.args["correct"]["end_time"]
+        return max(s, 0), e
+
+    def prepare(self, tm_codes):
+        """Get everything needed to cut `tm_codes`: download the video
+           (or its missing parts) and refresh the output folder index"""
+        spans = None  # download only what is needed to cut fragments
+        if self.args.get("partial_fetch") and self.cache is None:
+            spans = [self.span(tm) for tm in tm_codes]
+        if self.video is None or not self.video.exists() \
+           or spans is not None:
+            with self.limits.slot("download", self.name), \
+                 self.stat.span("download", job=self.name) as rec:
+                self.video, rec["bytes"] = gs.download_video(
+                    self.video_id, self.tempdir,
+                    self.args.get("download_workers") or 4, spans,
+                    self.cache, self.downloading, self.make_room)
+            if self.cache is None:  # shared videos are not ours to evict
+                self.store.add(self.video, localstore.SOURCE)
+
+        # get videos that are done
+        if self.folder is None:
+            self.folder = driveindex.FolderIndex(
+                gs.get_session(self.auth_token), self.outdir_id,
+                self.tempdir/"drive_index.json")
+        with self.stat.span("listing", job=self.name):
+            self.folder.refresh()
+
+        if self.manifest is None:
+            self.open_manifest(gs.get_checksum(self.video_id)
+                               or probe.checksum(self.video))
+
+    def open_manifest(self, source):
+        """Open cache of fragments of the video with `source` checksum
+           and choose the way to cut them"""
+        self.manifest = fragcache.Manifest(self.fragdir, source)
+        if self.args.get("transcode"):
+            with self.stat.span("probe", job=self.name):
+                keyframes = probe.keyframes(self.video)
+            self.transcoder = cut.Transcoder(
+                self.args["transcode"], keyframes,
+                self.args.get("encode_workers"),
+                self.args.get("transcode_chunk") or 30,
+                lambda: self.limits.slot("cut", self.name))
+            self.method = f"transcode {self.transcoder.id}"
+        elif self.args.get("smart_cut"):
+            with self.stat.span("probe", job=self.name):
+                self.probed = probe.probe(self.video)
+            self.method = f"smart {probe.encoder(self.probed)}"
+        elif self.args.get("batch_cut"):
+            self.method = "batch"
+        elif self.args.get("stream_upload") and self.args["do_upload"]:
+            self.method = "stream"
+
+    def make_room(self, video, size):
+        """Evict files to fit `video` of `size` bytes before it is
+           downloaded, so the disk doesn't hold it and them at once"""
+        self.store.forget(video)  # it is added again when downloaded
+        self.store.make_room(size, keep=video)
+
+    def evicted(self, path, kind):
+        """Clean up after file at `path` is evicted from local store"""
+        if kind == localstore.FRAGMENT:
+            if self.manifest is not None:
+                self.manifest.evicted(path)
+        else:
+            download.parts_file(path).unlink(missing_ok=True)
+            probe.index_file(path).unlink(missing_ok=True)
+
+    def filename(self, tm):
+        return cut.make_filename(self.video, tm, self.fragdir)
+
+    def key(self, tm):
+        return self.manifest.key(*self.span(tm), self.method)
+
+    def is_cut(self, tm):
+        return self.manifest.valid(self.filename(tm), self.key(tm))
+
+    def ready(self, tm):
+        """Return uploaded file of fragment, the same as cut locally
+           if it is, or None"""
+        frag = self.filename(tm)
+        key = self.key(tm)
+        if (md5 := self.manifest.md5(frag, key)) is not None:
+            return self.folder.lookup(frag.name, md5)
+        return self.folder.lookup(frag.name, key=key)  # unknown locally
+
+    def cut(self, tm, batch=None):
+        """Cut fragment by time code `tm`, return its file or None"""
+        frag = self.filename(tm)
+        if self.is_cut(tm):
+            self.store.touch(frag)
+            return frag
+        s, e = self.span(tm)
+        tmp = self.manifest.temp(frag)
+        # the transcoder takes a slot for each of its ffmpeg processes
+        slot = (self.limits.slot("cut", self.name)
+                if self.transcoder is None else contextlib.nullcontext())
+        with slot, self.stat.span("cut", frag.name, job=self.name) as rec:
+            if self.transcoder is not None:
+                ok = self.transcoder.make_fragment(self.video, s, e, tmp)
+            elif self.probed is not None:
+                ok = cut.make_smart_fragment(self.video, s, e, tmp,
+                                             self.probed)
+            elif batch is not None:
+                ok = batch.make_fragment(tmp)
+            else:
+                ok = cut.make_fragment(self.video, ut.to_hhmmss(s),
+                                       ut.to_hhmmss(e), tmp)
+            if ok:
+                rec["bytes"] = tmp.stat().st_size
+        if not ok:
+            self.manifest.discard(frag)
+            return None
+        self.manifest.commit(frag, self.key(tm))
+        self.store.add(frag, localstore.FRAGMENT)
+        self.journal.record(tm, journal.CUT)
+        return frag
+
+    async def cut_async(self, tm, batch=None):
+        """Like `cut`, but wait for ffmpeg in asyncio event loop.
+           Other ways to cut and global limits of a batch of jobs
+           need a thread, so `cut` is run in one for them"""
+        if self.method != "copy" or self.limits.enabled:
+            return await asyncio.to_thread(self.cut, tm, batch)
+        frag = self.filename(tm)
+        if self.is_cut(tm):
+            return frag
+        s, e = self.span(tm)
+        tmp = self.manifest.temp(frag)
+        with self.stat.span("cut", frag.name, job=self.name) as rec:
+            ok = await cut.make_fragment_async(self.video, ut.to_hhmmss(s),
+                                               ut.to_hhmmss(e), tmp)
+            if ok:
+                rec["bytes"] = tmp.stat().st_size
+        if not ok:
+            self.manifest.discard(frag)
+            return None
+        await asyncio.to_thread(self.manifest.commit, frag, self.key(tm))
+        self.store.add(frag, localstore.FRAGMENT)
+        self.journal.record(tm, journal.CUT)
+        return frag
+
+    def stream(self, tm):
+        """Cut fragment by time code `tm` right into upload without
+           a local file, return line to report or None. If the stream
+           fails, the fragment is cut and uploaded the usual way"""
+        frag = self.filename(tm)
+        s, e = self.span(tm)
+        meta = None
+        with tempfile.TemporaryFile() as err, \
+             self.limits.slot("cut", self.name), \
+             self.limits.slot("upload", self.name), \
+             self.stat.span("stream", frag.name, job=self.name) as rec:
+            p = cut.open_stream(self.video, ut.to_hhmmss(s),
+                                ut.to_hhmmss(e), frag, err)
+            if p is not None:
+                try:
+                    meta = self.uploader.upload_stream(
+                        p.stdout, frag.name, self.outdir_id,
+                        finish=lambda: p.wait() == 0,
+                        properties={"key": self.key(tm)})
+                    rec["bytes"] = int(meta["size"])
+                except (requests.RequestException, upload.UploadError) as e:
+                    ut.logger().warning(f"failed to stream {frag.name},"
+                                        f" '{e}'")
+                finally:
+                    if meta is None:
+                        p.kill()
+                    p.stdout.close()
+                    if p.wait() and meta is None:
+                        err.seek(0)
+                        ut.logger().error(ut.decode(err.read()))
+
+        if meta is None:  # fall back to a local file
+            if (frag := self.cut(tm)) is None:
+                return None
+            return self.upload(tm, frag)
+        self.manifest.record(frag, self.key(tm), int(meta["size"]),
+                             meta.get("md5Checksum"))
+        self.folder.update(meta)
+        self.journal.record(tm, journal.UPLOADED, id=meta["id"])
+        return gs.meta_str(meta["mimeType"], meta["name"], int(meta["size"]))
+
+    def upload(self, tm, frag):
+        """Upload fragment `frag`, return line to report"""
+        if not self.args["do_upload"]:
+            return tm.name
+        with self.limits.slot("upload", self.name), \
+             self.stat.span("upload", frag.name, job=self.name,
+                            bytes=frag.stat().st_size):
+            meta = self.uploader.upload(frag, self.outdir_id,
+                                        properties={"key": self.key(tm)})
+        self.folder.update(meta)
+        self.store.uploaded(frag)
+        self.journal.record(tm, journal.UPLOADED, id=meta["id"])
+        return gs.meta_str(meta["mimeType"], meta["name"], int(meta["size"]))
+
+    def downloading(self, n_bytes, total):
+        """Called as the video is downloaded, `n_bytes` of `total` are"""
+
+    def report(self, line):
+        """Print `line` (list of items) of progress report"""
+        if self.name is not None:  # several jobs print at once
+            line = [f"[{self.name}]", *line]
+        print(*line, flush=True)
+
+    def run(self, tm_codes, stat):
+        """Cut and upload fragments by `tm_codes`, update statistics
+           `stat` and report progress in order of `tm_codes`.
+           Return time codes of failed fragments"""
+        self.stat = stat
+        if not tm_codes:  # e.g. all done by the interrupted run
+            self.journal.finish()
+            return []
+        self.prepare(tm_codes)
+        with self.store.pin(self.video):  # not to be evicted meanwhile
+            failed = self._run(tm_codes, stat)
+        self.journal.finish()  # a planned run is over
+        return failed
+
+    def _run(self, tm_codes, stat):
+        done = {tm: self.ready(tm) for tm in tm_codes}
+        for tm, file in done.items():
+            if file is not None:  # its local copy is not needed
+                self.store.uploaded(self.filename(tm))
+                self.journal.record(tm, journal.UPLOADED, id=file["id"])
+
+        batch = None  # cut close fragments by one ffmpeg pass
+        if self.method == "batch":
+            frags = [cut.Fragment(*self.span(tm),
+                                  self.manifest.temp(self.filename(tm)))
+                     for tm in tm_codes
+                     if done[tm] is None and not self.is_cut(tm)]
+            batch = cut.Batch(self.video, frags,
+                              probe.keyframes(self.video))
+
+        n_tm_codes = len(tm_codes)
+        w = len(f"{n_tm_codes}")  # for pretty print
+        failed = []
+        ut.logger().debug(f"cut with {self.workers} worker(s), upload with"
+                          f" {self.upload_workers} worker(s),"
+                          f" queue {self.queue_size}")
+        first, second = (lambda tm: self.cut(tm, batch)), self.upload
+        n_first = self.workers
+        if self.args.get("asyncio"):
+            first = functools.partial(self.cut_async, batch=batch)
+        if self.method == "stream":  # cut right into upload
+            first, second = self.stream, (lambda tm, line: line)
+            n_first = self.upload_workers
+        make = orchestrator.Orchestrator if self.args.get("asyncio") \
+            else pipeline.Pipeline
+        with make(first, second, n_first, self.upload_workers,
+                  self.queue_size) as pl:
+            jobs = {tm: pl.submit(tm) for tm in tm_codes  # report in order
+                    if done[tm] is None}
+
+            for i, tm in enumerate(tm_codes, 1):
+                stat.total += 1
+                line = [f"{i:0{w}d}/{n_tm_codes}"]
+                if (file := done[tm]) is not None:
+                    line += ['=', gs.meta_str(file["mimeType"], file["name"],
+                                              file["size"])]
+                    stat.ready += 1
+                    self.report(line)
+                    continue
+
+                line += [">"]
+                if self.name is None:  # show it is in progress
+                    print(*line, end=" ", flush=True)
+                    line = []
+                try:
+                    result = jobs[tm].result()
+                except Exception:  # e.g. the upload is out of retries,
+                    stat.failed += 1  # logged by the stage
+                    failed.append(tm)
+                    self.report([*line, "[FAILED] failed to upload",
+                                 self.filename(tm).name])
+                    continue
+                if result is None:
+                    stat.failed += 1
+                    failed.append(tm)
+                    self.report([*line, "[FAILED] failed to cut",
+                                 self.filename(tm).name])
+                    continue
+
+                self.report([*line, result])
+                if self.args["do_upload"]:
+                    stat.uploaded += 1
+
+        if self.folder is not None:
+            self.folder.save()
+        return failed
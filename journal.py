@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+import time
+
+import google_serve as gs
+import utils as ut
+
+
+PLANNED, CUT, UPLOADED, FINISHED = "planned", "cut", "uploaded", "finished"
+
+
+class Journal:
+    """Append-only journal of a run in JSON lines `file`.
+
+       The run starts with the list of time codes planned and the key
+       of the job they belong to, then every fragment cut or uploaded is
+       appended, each line is synced to disk. If the run is interrupted,
+       the next one of the same job replays the journal and goes on
+       with the rest of the time codes (see `resume`)"""
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.f = None  # open while the run is not finished
+        self.good = 0
+
+    def _append(self, event, **data):
+        line = json.dumps({"event": event, "time": time.time(), **data},
+                          ensure_ascii=False)
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.write(f"{line}\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def start(self, tm_codes, key=None):
+        """Start journal of a run of `tm_codes` of job with `key`"""
+        tmp = self.file.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            f.write(json.dumps({"event": PLANNED, "time": time.time(),
+                                "key": key, "tm_codes": tm_codes},
+                               ensure_ascii=False))
+            f.write("\n")
+        os.replace(tmp, self.file)
+        self.f = self.file.open("a", encoding="utf-8")
+
+    def record(self, tm, event, **data):
+        """Record `event` (CUT or UPLOADED) of time code `tm`"""
+        self._append(event, tm=tm, **data)
+
+    def finish(self):
+        self._append(FINISHED)
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    def replay(self):
+        """Return planned time codes of the last run, dict of their
+           last events, whether it is finished and its job key, or None"""
+        if not self.file.exists():
+            return None
+        planned, events, finished, key = None, {}, False, None
+        self.good = 0  # end of the last whole line
+        with self.file.open("rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise json.JSONDecodeError("no line end", "", 0)
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # torn by a crash
+                    ut.logger().warning(f"broken line in '{self.file}'")
+                    break
+                self.good += len(line)
+                if entry["event"] == PLANNED:
+                    planned = [gs.TmCode(*tm) for tm in entry["tm_codes"]]
+                    key = entry.get("key")
+                elif entry["event"] == FINISHED:
+                    finished = True
+                else:
+                    events[gs.TmCode(*entry["tm"])] = entry
+        if planned is None:
+            return None
+        return planned, events, finished, key
+
+    def resume(self, done_event=UPLOADED, key=None):
+        """Return time codes left and done (with `done_event`)
+           by the interrupted run of job with `key` and continue
+           its journal, or None if the last run is finished
+           or it is of another job"""
+        if (state := self.replay()) is None or state[2]:
+            return None
+        planned, events, _, last_key = state
+        if last_key != key:
+            ut.logger().warning(f"'{self.file}' is of another job,"
+                                " its run is not resumed")
+            return None
+        done = {tm for tm in planned
+                if events.get(tm, {}).get("event") == done_event}
+        with self.file.open("r+b") as f:
+            f.truncate(self.good)  # drop a torn line
+        self.f = self.file.open("a", encoding="utf-8")
+        return [tm for tm in planned if tm not in done], \
+            [tm for tm in planned if tm in done]
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import contextlib
+import json
+import os
+import pathlib
+import threading
+import time
+
+import utils as ut
+
+
+SOURCE, FRAGMENT = "source", "fragment"
+
+
+class LocalStore:
+    """Files of the temporary directory kept under `quota` bytes.
+
+       Source videos and fragments are registered in JSON index `file`
+       with their size and time of last use, so disk usage is known
+       without walking the directory. To make room, uploaded fragments
+       are evicted first, then least recently used source videos.
+       Pinned files (see `pin`) and fragments not uploaded yet are kept.
+       `on_evict(path, kind)` is called for every evicted file.
+       No limit if `quota` is 0"""
+
+    def __init__(self, file, quota=0, on_evict=None):
+        self.file, self.quota, self.on_evict = file, quota, on_evict
+        self.lock = threading.Lock()
+        self.pinned = {}  # number of pins by path
+        self.files = {}
+        if file.exists():
+            with file.open("r", encoding="utf-8") as f:
+                self.files = json.load(f)
+
+    def usage(self):
+        with self.lock:
+            return sum(e["size"] for e in self.files.values())
+
+    def add(self, path, kind):
+        """Register file at `path` of `kind` and make room for it"""
+        with self.lock:
+            entry = self.files.get(f"{path}", {"uploaded": False})
+            entry.update(kind=kind, size=path.stat().st_size,
+                         used=time.time())
+            self.files[f"{path}"] = entry
+            self._save()
+        self.make_room(keep=path)
+
+    def touch(self, path):
+        """Mark file at `path` as used just now"""
+        with self.lock:
+            if (entry := self.files.get(f"{path}")) is not None:
+                entry["used"] = time.time()
+                self._save()
+
+    def uploaded(self, path):
+        """Mark fragment at `path` as uploaded, so it may be evicted"""
+        with self.lock:
+            if (entry := self.files.get(f"{path}")) is not None:
+                entry["uploaded"] = True
+                self._save()
+        self.make_room()
+
+    @contextlib.contextmanager
+    def pin(self, path):
+        """Keep file at `path` in the block"""
+        key = f"{path}"
+        with self.lock:
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+        try:
+            yield path
+        finally:
+            with self.lock:
+                self.pinned[key] -= 1
+                if not self.pinned[key]:
+                    del self.pinned[key]
+            self.touch(path)
+
+    def forget(self, path):
+        """Remove file at `path` from the index"""
+        with self.lock:
+            if self.files.pop(f"{path}", None) is not None:
+                self._save()
+
+    def recent(self, kind):
+        """Return files of `kind`, recently used first"""
+        with self.lock:
+            files = [(e["used"], p) for p, e in self.files.items()
+                     if e["kind"] == kind]
+        return [pathlib.Path(p) for _, p in sorted(files, reverse=True)]
+
+    def candidates(self, keep=None):
+        """Return files which may be evicted in order of eviction,
+           except file at `keep`"""
+        with self.lock:
+            files = [(p, e) for p, e in self.files.items()
+                     if p not in self.pinned and p != f"{keep}"
+                     and (e["kind"] == SOURCE or e["uploaded"])]
+        return sorted(files, key=lambda f: (f[1]["kind"] != FRAGMENT,
+                                            f[1]["used"]))
+
+    def make_room(self, n_bytes=0, keep=None):
+        """Evict files except `keep` until `n_bytes` more fit
+           into the quota, return true if they fit"""
+        if not self.quota:
+            return True
+        usage = self.usage()
+        for key, entry in self.candidates(keep):
+            if usage + n_bytes <= self.quota:
+                break
+            with self.lock:  # it may be pinned meanwhile
+                if key in self.pinned or key not in self.files:
+                    continue
+                del self.files[key]
+                self._save()
+            ut.logger().debug(f"evict {entry['kind']} '{key}'"
+                              f" {ut.humansize(entry['size'])}")
+            path = pathlib.Path(key)
+            path.unlink(missing_ok=True)
+            usage -= entry["size"]
+            if self.on_evict is not None:
+                self.on_evict(path, entry["kind"])
+        if usage + n_bytes > self.quota:
+            ut.logger().warning(f"{ut.humansize(usage)} in use exceeds"
+                                f" quota {ut.humansize(self.quota)}")
+            return False
+        return True
+
+    def _save(self):
+        tmp = self.file.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(self.files, f, indent=1)
+        os.replace(tmp, self.file)
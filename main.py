@@ -3,10 +3,12 @@
 import argparse
 import json5 as json
 import pathlib
+import sys
+import time
 import traceback
 
 import cut
-import google_serve as gs
+import probe
 import utils as ut
 import version as vrs
 
@@ -35,89 +37,129 @@ def parse_args(parser):
     return args
 
 
+def watch(job, stat, interval):
+    """Process newly checked or changed worksheet rows
+       every `interval` seconds until interrupted"""
+    known = set()
+    while True:
+        try:
+            with stat.span("sheet"):
+                tm_codes = job.load_timing()
+            new = [tm for tm in tm_codes if tm not in known]
+            if new:
+                print(f"Found {len(new)} new time code(s)")
+                failed = job.run(new, stat)
+                known = set(tm_codes) - set(failed)  # retry failed ones
+        except Exception:
+            ut.logger().exception("failed to process worksheet changes")
+            print("[FAILED] see the log file for details, retry later")
+        time.sleep(interval)
+
+
+def save_report(stat, args):
+    """Save metrics and timeline of the run if asked in settings"""
+    if file := args.get("metrics_file"):
+        stat.save(file)
+    if file := args.get("trace_file"):
+        stat.save_trace(file)
+
+
 def main():
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument("--config", type=pathlib.Path,
                         default=ut.application_path()/"config.json",
                         help="file with slicing settings in JSON5 format"
                              " [default: %(default)s]")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process newly checked rows"
+                             " of the worksheet")
+    parser.add_argument("--coordinator", action="store_true",
+                        help="put checked rows of the worksheet into the"
+                             " work queue and wait for workers to do them")
+    parser.add_argument("--worker", action="store_true",
+                        help="cut and upload fragments from the work queue")
+    parser.add_argument("--serve", action="store_true",
+                        help="run web server to take jobs from several"
+                             " users and show their progress")
+    parser.add_argument("--plan", action="store_true",
+                        help="print fragments to cut by the last fetched"
+                             " worksheet (or --sheet) offline")
+    parser.add_argument("--offline", action="store_true",
+                        help="cut fragments like --plan shows locally,"
+                             " without Google Drive")
+    parser.add_argument("--sheet", type=pathlib.Path,
+                        help="worksheet exported as CSV for --plan and"
+                             " --offline [default: time codes kept in"
+                             " temporary dir]")
+    parser.add_argument("--video", type=pathlib.Path,
+                        help="local source video for --plan and --offline"
+                             " [default: the last downloaded one]")
     parser.add_argument("--version", action="version",
                         version=f"%(prog)s {vrs.get_version()}")
 
     args = parse_args(parser)
     cut.ffmpeg = ut.as_command(args["ffmpeg"])
     ut.set_log_level(args["log_level"])
+    if args.get("ffprobe"):
+        try:
+            probe.ffprobe = ut.as_command(args["ffprobe"])
+        except RuntimeError as e:  # needed only for non-MP4 videos
+            ut.logger().warning(f"{e}, non-MP4 videos can't be probed")
     ut.logger().debug(f"version is '{vrs.get_version()}'")
     ut.logger().debug(f"arguments - {args}")
 
     stat = ut.Statistics()
-    auth_token = ut.checked_path(args["auth_token"])
-    gd = gs.get_drive(auth_token)
-    tempdir = pathlib.Path(args["temporary_dir"])
-
-    ut.logger().debug(f"create temporary dir '{tempdir.resolve()}'")
-    tempdir.mkdir(parents=True, exist_ok=True)
-
-    video = gs.download_video(gs.as_id(args["video_url"]), tempdir)
-
-    # extract time codes from google worksheet
-    wsht = gs.open_worksheet(gs.get_sheet(auth_token), args["worksheet_url"])
-    tm_codes = gs.extract_timing(wsht,
-                                 args["head_row"],
-                                 args["n_head_rows"],
-                                 gs.TabColumns(
-                                    args["columns"]["slice"],
-                                    args["columns"]["start"],
-                                    args["columns"]["end"],
-                                    args["columns"]["name"],
-                                 ))
-    n_tm_codes = len(tm_codes)
-    print(f"Extracted {n_tm_codes} time code(s)")
-
-    # get videos that are done
-    outdir_id = gs.as_id(args["output_dir_url"])
-    ready_videos = gs.list_videos(outdir_id)
-
-    # cut fragments by time code
-    fragdir = tempdir/"fragments"
-    fragdir.mkdir(exist_ok=True)
-
-    w = len(f"{n_tm_codes}")  # for pretty print
-    for tm in tm_codes:
-        frag = cut.make_filename(video, tm, fragdir)
-        stat.total += 1
-        print(f"{stat.total:0{w}d}/{n_tm_codes}", end=" ")
-        if frag.name in ready_videos:
-            info = gs.get_meta(ready_videos[frag.name])
-            print('=', gs.meta_str(*info))
-            stat.ready += 1
-            continue
-
-        print(">", end=" ", flush=True)
-        if not frag.exists():
-            s = cut.correct_time_by(tm.start, args["correct"]["start_time"])
-            e = cut.correct_time_by(tm.end, args["correct"]["end_time"])
-            ok = cut.make_fragment(video, s, e, frag)
-            if not ok:
-                stat.failed += 1
-                print("[FAILED] failed to cut", frag.name)
-                continue
-
-        v = gd.CreateFile(metadata={
-            "parents": [
-                {"id": outdir_id}
-            ],
-            "title": frag.name
-        })
-        if args["do_upload"]:
-            v.SetContentFile(f"{frag.resolve()}")
-            v.Upload()
-            print(gs.meta_str(*gs.get_meta(v)))
-            stat.uploaded += 1
+    if args["plan"] or args["offline"]:  # no Google modules are needed
+        import plan
+        plan.run(args, stat)
+        if args["offline"]:
+            stat.report()
+            save_report(stat, args)
+        return
+
+    # imported here, so offline modes start fast
+    import ratelimit
+    import scheduler
+    import workqueue
+    from job import Job
+    ratelimit.configure(args.get("rate_limits"))
+    if args["serve"]:  # jobs come from users
+        import server
+        try:
+            server.serve(args)
+        except KeyboardInterrupt:
+            print("Stopped")
+        return
+
+    if "jobs" in args:  # batch of jobs
+        stats = scheduler.run_batch(args, Job, stat)
+        print()
+        for name, job_stat in stats.items():
+            print(f"[{name}] total {job_stat.total}, ready {job_stat.ready},"
+                  f" uploaded {job_stat.uploaded}, failed {job_stat.failed}")
+        stat.report()
+        save_report(stat, args)
+        return
+
+    job = Job(args)
+    if args["coordinator"] or args["worker"]:  # several machines
+        queue = workqueue.WorkQueue(args["queue"],
+                                    args.get("lease") or 600)
+        if args["coordinator"]:
+            workqueue.coordinate(job, queue, stat)
         else:
-            print(tm.name, flush=True)
-
+            workqueue.work(job, queue, stat)
+    elif args["watch"]:
+        try:
+            watch(job, stat, args.get("watch_interval") or 10)
+        except KeyboardInterrupt:
+            print("Stopped")
+    else:
+        tm_codes = job.plan(stat)
+        print(f"Extracted {len(tm_codes)} time code(s)")
+        job.run(tm_codes, stat)
     stat.report()
+    save_report(stat, args)
 
 
 if __name__ == "__main__":
@@ -128,4 +170,5 @@ if __name__ == "__main__":
         ut.logger().critical(exc)
         print(exc)
 
-    input("Press Enter to exit...")
+    if sys.stdin.isatty():  # not run by a script
+        input("Press Enter to exit...")
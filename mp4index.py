@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import bisect
+import struct
+
+
+class FormatError(RuntimeError):
+    pass
+
+
+def boxes(read, start, end):
+    """Yield (type, offset, header size, size) of MP4 boxes
+       laid out in [start, end) by `read(offset, n)` function"""
+    o = start
+    while o + 8 <= end:
+        hdr = read(o, 16)
+        if len(hdr) < 8:
+            raise FormatError(f"truncated box header at {o}")
+        size, kind = struct.unpack(">I4s", hdr[:8])
+        hsize = 8
+        if size == 1:
+            if len(hdr) < 16:
+                raise FormatError(f"truncated box header at {o}")
+            size, hsize = struct.unpack(">Q", hdr[8:16])[0], 16
+        elif size == 0:  # up to the end
+            size = end - o
+        if size < hsize:
+            raise FormatError(f"bad box size at {o}")
+        yield kind.decode("latin-1"), o, hsize, size
+        o += size
+
+
+def _child(buf, start, end, kind):
+    """Return payload (start, end) of the first `kind` box in `buf`"""
+    def read(a, n):
+        return buf[a:a+n]
+
+    for k, o, hsize, size in boxes(read, start, end):
+        if k == kind:
+            return o + hsize, o + size
+    return None
+
+
+def _path(buf, start, end, *kinds):
+    for kind in kinds:
+        if (r := _child(buf, start, end, kind)) is None:
+            return None
+        start, end = r
+    return start, end
+
+
+def _table(buf, box, fmt):
+    """Return entries of a full box table `box` with entries in `fmt`"""
+    start, _ = box
+    n, = struct.unpack_from(">I", buf, start + 4)
+    end = start + 8 + n*struct.calcsize(fmt)
+    return list(struct.iter_unpack(fmt, buf[start+8:end]))
+
+
+_CHROMA = {0: "420", 1: "420", 2: "422", 3: "444"}  # by chroma_format_idc
+
+
+def _as_pix_fmt(chroma, depth):
+    """Return ffmpeg pixel format of YUV `chroma` format and bit `depth`"""
+    if chroma not in (1, 2, 3):  # monochrome or unknown
+        return None
+    return f"yuv{_CHROMA[chroma]}p" + ("" if depth == 8 else f"{depth}le")
+
+
+def _pix_fmt(buf, start, end, codec):
+    """Return pixel format from visual sample entry in [start, end)
+       of `codec` or None if it isn't known"""
+    children = start + 8 + 78  # after the sample entry fields
+    if codec in ("avc1", "avc3"):
+        if (avcc := _child(buf, children, end, "avcC")) is None:
+            return None
+        a, b = avcc
+        profile = buf[a + 1]
+        if profile in (66, 77, 88):  # Baseline, Main and Extended
+            return "yuv420p"
+        o = a + 6
+        for _ in range(buf[a + 5] & 0x1f):  # SPS
+            o += 2 + struct.unpack_from(">H", buf, o)[0]
+        for _ in range(buf[o]):  # PPS
+            o += 2 + struct.unpack_from(">H", buf, o + 1)[0]
+        o += 1
+        if o + 2 > b:  # no extension with the format
+            return None
+        return _as_pix_fmt(buf[o] & 0x03, (buf[o + 1] & 0x07) + 8)
+    if codec in ("hvc1", "hev1"):
+        if (hvcc := _child(buf, children, end, "hvcC")) is None \
+           or hvcc[1] - hvcc[0] < 18:
+            return None
+        a = hvcc[0]
+        return _as_pix_fmt(buf[a + 16] & 0x03, (buf[a + 17] & 0x07) + 8)
+    if codec == "vp09":
+        if (vpcc := _child(buf, children, end, "vpcC")) is None \
+           or vpcc[1] - vpcc[0] < 7:
+            return None
+        bits = buf[vpcc[0] + 6]
+        return _as_pix_fmt(max((bits >> 1) & 0x07, 1), bits >> 4)
+    return None
+
+
+class Track:
+    """Sample table of MP4 track: decode times, file offsets and sizes"""
+
+    def __init__(self, buf, start, end):
+        mdia = _path(buf, start, end, "mdia")
+        mdhd = _path(buf, *mdia, "mdhd")
+        hdlr = _path(buf, *mdia, "hdlr")
+        stbl = _path(buf, *mdia, "minf", "stbl")
+        if None in (mdhd, hdlr, stbl):
+            raise FormatError("incomplete track")
+
+        version = buf[mdhd[0]]
+        pos = mdhd[0] + (20 if version == 1 else 12)
+        self.timescale, = struct.unpack_from(">I", buf, pos)
+        self.handler = bytes(buf[hdlr[0]+8:hdlr[0]+12]).decode("latin-1")
+        self.codec = None  # format of the first sample description
+        self.pix_fmt = None
+        if (stsd := _path(buf, *stbl, "stsd")) is not None:
+            self.codec = bytes(buf[stsd[0]+12:stsd[0]+16]).decode("latin-1")
+            if self.handler == "vide":
+                entry = stsd[0] + 8
+                size, = struct.unpack_from(">I", buf, entry)
+                self.pix_fmt = _pix_fmt(buf, entry, min(entry + size,
+                                                        stsd[1]), self.codec)
+
+        self.times = []
+        t = 0
+        for count, delta in _table(buf, _path(buf, *stbl, "stts"), ">II"):
+            for _ in range(count):
+                self.times.append(t)
+                t += delta
+
+        stsz = _path(buf, *stbl, "stsz")
+        size, count = struct.unpack_from(">II", buf, stsz[0] + 4)
+        if size:
+            self.sizes = [size] * count
+        else:
+            self.sizes = [s for s, in struct.iter_unpack(
+                ">I", buf[stsz[0]+12:stsz[0]+12+4*count])]
+
+        if (stco := _path(buf, *stbl, "stco")) is not None:
+            chunks = [c for c, in _table(buf, stco, ">I")]
+        elif (co64 := _path(buf, *stbl, "co64")) is not None:
+            chunks = [c for c, in _table(buf, co64, ">Q")]
+        else:
+            raise FormatError("no chunk offsets")
+
+        stsc = _table(buf, _path(buf, *stbl, "stsc"), ">III")
+        self.offsets = []
+        i = 0
+        for k, (first, per_chunk, _) in enumerate(stsc):
+            last = stsc[k+1][0] if k + 1 < len(stsc) else len(chunks) + 1
+            for c in range(first - 1, last - 1):
+                o = chunks[c]
+                for _ in range(per_chunk):
+                    if i >= len(self.sizes):
+                        break
+                    self.offsets.append(o)
+                    o += self.sizes[i]
+                    i += 1
+
+        self.sync = None  # all samples are sync ones
+        if (stss := _path(buf, *stbl, "stss")) is not None:
+            self.sync = [s - 1 for s, in _table(buf, stss, ">I")]
+
+    def byte_ranges(self, start, end):
+        """Return byte ranges of samples between `start`
+           and `end` seconds including the sync sample before"""
+        n = min(len(self.times), len(self.offsets))
+        i = bisect.bisect_right(self.times, start * self.timescale, 0, n) - 1
+        j = bisect.bisect_right(self.times, end * self.timescale, 0, n)
+        i = max(i, 0)
+        if self.sync:
+            k = bisect.bisect_right(self.sync, i) - 1
+            i = self.sync[max(k, 0)]
+        ranges = []
+        for s in range(i, j):
+            a, b = self.offsets[s], self.offsets[s] + self.sizes[s]
+            if ranges and ranges[-1][1] == a:
+                ranges[-1][1] = b
+            else:
+                ranges.append([a, b])
+        return [tuple(r) for r in ranges]
+
+
+class Index:
+    """Index of MP4 file: top-level boxes and sample tables of tracks"""
+
+    def __init__(self, read, size):
+        self.headers = []  # byte ranges of everything except media data
+        self.tracks = []
+        moov = None
+        for kind, o, hsize, bsize in boxes(read, 0, size):
+            if kind == "mdat":
+                self.headers.append((o, o + hsize))
+            else:
+                self.headers.append((o, min(o + bsize, size)))
+            if kind == "moov":
+                moov = o, hsize, bsize
+            elif kind == "moof":  # samples aren't in the sample tables
+                raise FormatError("fragmented MP4 file")
+        if moov is None:
+            raise FormatError("no 'moov' box, not an MP4 file?")
+
+        o, hsize, bsize = moov
+        buf = memoryview(read(o, bsize))
+        for kind, t, thsize, tsize in boxes(lambda a, n: buf[a:a+n],
+                                            hsize, bsize):
+            if kind == "trak":
+                track = Track(buf, t + thsize, t + tsize)
+                if track.handler in ("vide", "soun"):
+                    self.tracks.append(track)
+        if not self.tracks or not all(t.times and t.offsets
+                                      for t in self.tracks):
+            raise FormatError("no samples in the sample tables")
+
+    def keyframes(self):
+        """Return sync sample times of the video track in seconds"""
+        for track in self.tracks:
+            if track.handler == "vide":
+                sync = track.sync or range(len(track.times))
+                return [track.times[i] / track.timescale for i in sync]
+        return []
+
+    def byte_ranges(self, spans, margin=1.0):
+        """Return sorted byte ranges needed to cut time `spans`,
+           a list of (start, end) in seconds, with `margin` seconds"""
+        ranges = list(self.headers)
+        for track in self.tracks:
+            for start, end in spans:
+                ranges += track.byte_ranges(max(start - margin, 0),
+                                            end + margin)
+        return merge(ranges)
+
+
+def merge(ranges):
+    """Return sorted list of non-overlapping byte ranges"""
+    result = []
+    for a, b in sorted(ranges):
+        if result and a <= result[-1][1]:
+            result[-1] = result[-1][0], max(result[-1][1], b)
+        else:
+            result.append((a, b))
+    return result
+
+
+def load(path):
+    """Return index of local MP4 file at `path`"""
+    with path.open("rb") as f:
+        def read(offset, n):
+            f.seek(offset)
+            return f.read(n)
+
+        return Index(read, path.stat().st_size)
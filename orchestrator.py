@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+
+from concurrent import futures
+
+import utils as ut
+
+
+class Orchestrator:
+    """Two-stage pipeline like `pipeline.Pipeline` run by an asyncio
+       event loop in a background thread.
+
+       Coroutine functions `first` and `second` run in the loop, so
+       hundreds of items waiting for ffmpeg processes don't need a thread
+       each; plain functions run in a pool of `n_first + n_second`
+       threads. At most `n_first` items are in the first stage,
+       `n_second` in the second one and `queue_size` wait between them.
+
+       If `first` returns None, the item is not passed to `second`"""
+
+    def __init__(self, first, second, n_first=1, n_second=1, queue_size=1):
+        self.first, self.second = first, second
+        self.n_first, self.n_second = max(n_first, 1), max(n_second, 1)
+        self.queue_size = max(queue_size, 1)
+        self.futures = []
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(futures.ThreadPoolExecutor(
+            self.n_first + self.n_second))
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+
+    async def _setup(self):  # semaphores are bound to the loop
+        self.first_slots = asyncio.Semaphore(self.n_first)
+        self.second_slots = asyncio.Semaphore(self.n_second)
+        self.in_flight = asyncio.Semaphore(self.n_first + self.queue_size
+                                           + self.n_second)
+
+    @staticmethod
+    async def _call(func, *args):
+        if asyncio.iscoroutinefunction(func):
+            return await func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def _process(self, item):
+        async with self.in_flight:
+            async with self.first_slots:
+                try:
+                    result = await self._call(self.first, item)
+                except Exception:
+                    ut.logger().exception(f"first stage failed on {item}")
+                    raise
+            if result is None:
+                return None
+            async with self.second_slots:
+                try:
+                    return await self._call(self.second, item, result)
+                except Exception:
+                    ut.logger().exception(f"second stage failed on {item}")
+                    raise
+
+    def submit(self, item):
+        """Queue `item` for processing, return future with the final result"""
+        future = asyncio.run_coroutine_threadsafe(self._process(item),
+                                                  self.loop)
+        self.futures.append(future)
+        return future
+
+    def close(self, cancel=False):
+        """Wait for all submitted items to be processed.
+           Pending items are cancelled if `cancel` is true"""
+        if cancel:
+            for f in self.futures:
+                f.cancel()
+        futures.wait(self.futures)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
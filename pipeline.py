@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+
+from concurrent import futures
+
+import utils as ut
+
+
+_stop = object()  # sentinel to finish worker threads
+
+
+class Pipeline:
+    """Two-stage producer/consumer pipeline.
+
+       Items are processed by `first` in `n_first` threads and the results
+       are put into a queue of `queue_size` items, which is drained by
+       `second` in `n_second` threads. The queue is bounded, so the first
+       stage waits while the second one lags behind (backpressure).
+
+       If `first` returns None, the item is not passed to `second`"""
+
+    def __init__(self, first, second, n_first=1, n_second=1, queue_size=1):
+        self.first, self.second = first, second
+        self.n_first, self.n_second = max(n_first, 1), max(n_second, 1)
+        self.n_first_done = 0
+        self.lock = threading.Lock()
+        self.inbox = queue.Queue()
+        self.outbox = queue.Queue(maxsize=max(queue_size, 1))
+        self.cancelled = threading.Event()
+        self.threads = [
+            *[threading.Thread(target=self._run_first, daemon=True)
+              for _ in range(self.n_first)],
+            *[threading.Thread(target=self._run_second, daemon=True)
+              for _ in range(self.n_second)],
+        ]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, item):
+        """Queue `item` for processing, return future with the final result"""
+        future = futures.Future()
+        self.inbox.put((item, future))
+        return future
+
+    def close(self, cancel=False):
+        """Wait for all submitted items to be processed.
+           Pending items are cancelled if `cancel` is true"""
+        if cancel:
+            self.cancelled.set()
+        for _ in range(self.n_first):
+            self.inbox.put(_stop)
+        for t in self.threads:
+            t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+
+    def _run_first(self):
+        while (job := self.inbox.get()) is not _stop:
+            item, future = job
+            if self.cancelled.is_set():
+                future.cancel()
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self.first(item)
+            except BaseException as e:
+                ut.logger().exception(f"first stage failed on {item}")
+                future.set_exception(e)
+                continue
+            if result is None:
+                future.set_result(None)
+                continue
+            self.outbox.put((item, result, future))  # blocks if full
+
+        with self.lock:  # last one stops the second stage
+            self.n_first_done += 1
+            if self.n_first_done == self.n_first:
+                for _ in range(self.n_second):
+                    self.outbox.put(_stop)
+
+    def _run_second(self):
+        while (job := self.outbox.get()) is not _stop:
+            item, value, future = job
+            if self.cancelled.is_set():
+                future.set_exception(futures.CancelledError())
+                continue
+            try:
+                future.set_result(self.second(item, value))
+            except BaseException as e:
+                ut.logger().exception(f"second stage failed on {item}")
+                future.set_exception(e)
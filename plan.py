@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+
+import download
+import google_serve as gs
+import localstore
+import probe
+import utils as ut
+
+from job import Job
+
+
+class LocalJob(Job):
+    """Job cutting local `video` by time codes without Google Drive:
+       nothing is downloaded or uploaded, no authorization is needed.
+       The video is the one used last by the job if not given"""
+
+    def __init__(self, args, video=None):
+        super().__init__({**args, "do_upload": False})
+        self.video = video or self.find_video()
+
+    def connect(self):
+        self.auth_token = None
+        self.video_id = self.outdir_id = None
+        self.uploader = None
+
+    def find_video(self):
+        for video in self.store.recent(localstore.SOURCE):
+            if not video.exists():
+                continue
+            if download.parts_file(video).exists():
+                ut.logger().warning(f"'{video.name}' is downloaded partially,"
+                                    " only fragments of the last run"
+                                    " may be cut")
+            return video
+        raise RuntimeError("no local video found, give one by --video")
+
+    def prepare(self, tm_codes):
+        if self.manifest is None:  # the same as of the video on Drive
+            self.open_manifest(download.verified_md5(self.video)
+                               or probe.checksum(self.video))
+
+    def ready(self, tm):
+        return None
+
+
+def columns(args):
+    return gs.TabColumns(*(args["columns"][c] for c in gs.TabColumns._fields))
+
+
+def load_timing(args, sheet):
+    """Return time codes from `sheet`: JSON file of time codes
+       kept by the last online run or the worksheet exported as CSV"""
+    if sheet.suffix.lower() != ".csv":
+        with sheet.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+        key = [args.get("worksheet_url"), args["head_row"],
+               args["n_head_rows"], list(columns(args))]
+        if data.get("key") != key:
+            ut.logger().warning(f"'{sheet}' is made with other settings")
+        return [gs.TmCode(*tm) for tm in data["tm_codes"]]
+
+    with sheet.open("r", encoding="utf-8-sig", newline="") as f:
+        table = list(csv.reader(f))
+    header = table[args["head_row"] - 1]
+    rows = [row + [""] * (len(header) - len(row))
+            for row in table[args["n_head_rows"]:]]
+    rows = gs.filter_rows(header, rows, columns(args))
+    return gs.make_timing(rows, args["n_head_rows"])
+
+
+def show(job, tm_codes):
+    """Print fragments to cut by `tm_codes` with corrected time spans"""
+    print(">", job.video, f"({job.method})")
+    n_tm_codes = len(tm_codes)
+    w = len(f"{n_tm_codes}")  # for pretty print
+    n_cut = 0
+    for i, tm in enumerate(tm_codes, 1):
+        s, e = job.span(tm)
+        done = job.is_cut(tm)
+        n_cut += done
+        print(f"{i:0{w}d}/{n_tm_codes}", f"row {tm.row}",
+              f"{ut.to_hhmmss(s)}-{ut.to_hhmmss(e)}",
+              "=" if done else ">", job.filename(tm).name)
+    print(f"{n_tm_codes - n_cut} to cut, {n_cut} cut already")
+
+
+def run(args, stat):
+    """Print the plan of the job by `args` or cut its fragments
+       locally if not `args["plan"]`, all offline"""
+    if "jobs" in args:
+        raise RuntimeError("a batch of jobs can't be planned offline,"
+                           " give settings of one job")
+    job = LocalJob(args, args.get("video"))
+    sheet = args.get("sheet") or job.tempdir/"worksheet.json"
+    if not sheet.exists():
+        raise RuntimeError(f"no time codes in '{sheet}', run online once"
+                           " or give the worksheet by --sheet")
+    with stat.span("sheet"):
+        tm_codes = load_timing(args, sheet)
+    print(f"Extracted {len(tm_codes)} time code(s)")
+    job.prepare(tm_codes)
+    if args["plan"]:
+        show(job, tm_codes)
+    else:
+        job.run(tm_codes, stat)
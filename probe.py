@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import subprocess as sp
+
+import mp4index
+import utils as ut
+
+
+ffprobe = None  # set in main module, optional for MP4 files
+
+_encoders = {
+    "h264": "libx264",
+    "hevc": "libx265",
+    "vp9": "libvpx-vp9",
+    "mpeg4": "mpeg4",
+}
+
+_fourcc = {
+    "avc1": "h264",
+    "avc3": "h264",
+    "hvc1": "hevc",
+    "hev1": "hevc",
+    "vp09": "vp9",
+    "mp4v": "mpeg4",
+}
+
+
+def index_file(video):
+    """Return file to cache keyframe index of `video`"""
+    return video.with_name(f"{video.name}.keyframes")
+
+
+def checksum(video, n=1024*1024):
+    """Return checksum of `n` bytes at the start and the end of `video`"""
+    h = hashlib.md5()
+    size = video.stat().st_size
+    with video.open("rb") as f:
+        h.update(f.read(n))
+        f.seek(max(size - n, 0))
+        h.update(f.read(n))
+    return h.hexdigest()
+
+
+FORMAT = 2  # of the cached index, older ones are probed again
+
+
+def _key(video):
+    st = video.stat()
+    return {
+        "format": FORMAT,
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "checksum": checksum(video),
+    }
+
+
+def load(video):
+    """Return cached index of `video` or None if missing or outdated"""
+    file = index_file(video)
+    if not file.exists():
+        return None
+    with file.open("r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("key") != _key(video):
+        ut.logger().debug(f"outdated keyframe index '{file}'")
+        return None
+    return data
+
+
+def save(video, data):
+    file = index_file(video)
+    tmp = file.with_suffix(f".{os.getpid()}.tmp")  # may be shared
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump({"key": _key(video), **data}, f)
+    os.replace(tmp, file)
+
+
+def _probe_mp4(video):
+    index = mp4index.load(video)
+    codec, pix_fmt = None, None
+    for track in index.tracks:
+        if track.handler == "vide":
+            codec, pix_fmt = _fourcc.get(track.codec), track.pix_fmt
+            break
+    return {
+        "keyframes": index.keyframes(),
+        "codec": codec,
+        "pix_fmt": pix_fmt,  # None if not known
+    }
+
+
+def _run(*args):
+    p = sp.run([f"{ffprobe}", "-v", "error", *args], capture_output=True)
+    if p.returncode:
+        raise RuntimeError(f"ffprobe failed, {ut.decode(p.stderr)}")
+    return ut.decode(p.stdout)
+
+
+def _probe_ffprobe(video):
+    out = _run("-select_streams", "v:0",
+               "-show_entries", "stream=codec_name,pix_fmt",
+               "-of", "json", f"{video}")
+    stream = json.loads(out)["streams"][0]
+    out = _run("-select_streams", "v:0",
+               "-show_entries", "packet=pts_time,flags",
+               "-of", "csv=p=0", f"{video}")
+    keyframes = []
+    for line in out.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            keyframes.append(float(pts))
+    return {
+        "keyframes": sorted(keyframes),
+        "codec": stream.get("codec_name"),
+        "pix_fmt": stream.get("pix_fmt"),
+    }
+
+
+def probe(video):
+    """Return keyframe times, video codec and pixel format of `video`.
+       The result is cached next to the video (see `index_file`)"""
+    if (data := load(video)) is not None:
+        return data
+
+    ut.logger().debug(f"probe '{video}'")
+    try:
+        data = _probe_mp4(video)  # fast and works for partial downloads
+    except (mp4index.FormatError, OSError) as e:
+        if ffprobe is None:
+            ut.logger().warning(f"failed to probe '{video}', '{e}'")
+            return None
+        data = _probe_ffprobe(video)
+    save(video, data)
+    return data
+
+
+def keyframes(video):
+    """Return sorted keyframe times of `video` or None if unknown"""
+    data = probe(video)
+    return data["keyframes"] if data is not None else None
+
+
+def encoder(data):
+    """Return ffmpeg encoder for video probed as `data` or None"""
+    return _encoders.get(data["codec"]) if data is not None else None
@@ -25,9 +25,17 @@ OS_NAME, MACHINE, ARCH = (sys.platform, platform.machine().lower(), platform.arc
 if MACHINE in ('x86', 'x86_64', 'amd64', 'i386', 'i686'):
     MACHINE = 'x86' if ARCH == '32' else ''
 
+# Max seconds the executable may take to start (see `check_startup`),
+# may be changed with --startup-budget=SECONDS
+STARTUP_BUDGET = 3.0
+
 
 def main():
     opts, version = parse_options(), read_version()
+    budget = STARTUP_BUDGET
+    for opt in [o for o in opts if o.startswith('--startup-budget=')]:
+        budget = float(opt.split('=', 1)[1])
+        opts.remove(opt)
 
     onedir = '--onedir' in opts or '-D' in opts
     if not onedir and '-F' not in opts and '--onefile' not in opts:
@@ -49,6 +57,7 @@ def main():
     print(f'Running PyInstaller with {opts}')
     run_pyinstaller(opts)
     set_version_info(final_file, version)
+    check_startup(final_file, budget)
 
     from pathlib import Path
     dist = Path(final_file).parent
@@ -83,6 +92,26 @@ def exe(onedir):
     )))
 
 
+def check_startup(exe, budget, runs=5):
+    """Measure time to start `exe` and fail the build if the median
+       of `runs` is over `budget` seconds. Heavy modules are imported
+       lazily by the tool, so a regression shows up here"""
+    import statistics
+    import subprocess
+    import time
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([exe, '--version'], check=True, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    print(f'Startup time: {times[0]:.2f} s cold, {median:.2f} s median'
+          f' (budget {budget:.2f} s)')
+    if median > budget:
+        raise Exception(f'Startup time {median:.2f} s exceeds budget {budget:.2f} s')
+
+
 def version_to_list(version):
     version_list = version.split('-')[0].split('.')
     return list(map(int, version_list)) + [0] * (4 - len(version_list))
@@ -141,6 +170,7 @@ def windows_set_version(exe, version):
 
 def copy_all_needs(dist):
     shutil.copy("config.sample.json", dist)
+    shutil.copy("batch.sample.json", dist)
     shutil.copytree("tools", dist/"tools", dirs_exist_ok=True,
                     ignore=shutil.ignore_patterns("*.json"))
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import email.utils
+import random
+import threading
+import time
+
+from urllib.parse import urlparse
+
+import requests.adapters
+
+import utils as ut
+
+
+# requests per second and max concurrent requests by API,
+# may be changed in main module (see `configure`)
+RATES = {"drive": 20., "sheets": 1.}
+CONCURRENCY = {"drive": 16, "sheets": 4}
+
+QUOTA_REASONS = ("rateLimitExceeded", "userRateLimitExceeded",
+                 "RATE_LIMIT_EXCEEDED", "RESOURCE_EXHAUSTED")
+
+
+class TokenBucket:
+    """Let `rate` calls per second pass on average, up to `burst` at once"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Wait for a token and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens
+                                  + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    """Concurrency limit halved on every quota error and raised by one
+       after as many successful calls as the limit (AIMD), so the load
+       stays close to the quota instead of swinging around it"""
+
+    def __init__(self, limit):
+        self.max = self.limit = max(limit, 1)
+        self.active = 0
+        self.successes = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                if self.limit > 1:
+                    self.limit //= 2
+                    ut.logger().info(f"concurrency lowered to {self.limit}")
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max:
+                    self.limit += 1
+                    self.successes = 0
+            self.cond.notify_all()
+
+
+class Limiter:
+    """Rate and concurrency limits of one API with retries
+       of calls failed for quota reasons"""
+
+    def __init__(self, rate, concurrency, retries=8):
+        self.bucket = TokenBucket(rate)
+        self.limit = AdaptiveLimit(concurrency)
+        self.retries = retries
+
+    def call(self, func, is_throttled, retry_after=lambda r: None):
+        """Return result of `func()` retried while `is_throttled(result
+           or exception)`. Delay before retry is taken from
+           `retry_after(result or exception)` or exponential with jitter"""
+        for attempt in range(self.retries + 1):
+            self.bucket.take()
+            self.limit.acquire()
+            result, error = None, None
+            try:
+                result = func()
+            except Exception as e:
+                error = e
+            outcome = result if error is None else error
+            throttled = is_throttled(outcome)
+            self.limit.release(throttled)
+            if not throttled or attempt == self.retries:
+                break
+            delay = retry_after(outcome)
+            if delay is None:
+                delay = random.uniform(0, min(2**attempt, 64))  # full jitter
+            ut.logger().warning(f"quota exceeded, retry in {delay:.1f} s")
+            if isinstance(outcome, requests.Response):
+                outcome.close()
+            time.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def configure(rates=None):
+    """Set requests per second by API, e.g. {"drive": 10}"""
+    RATES.update(rates or {})
+
+
+def limiter(api):
+    """Return limiter of `api` shared by all clients"""
+    with _lock:
+        if api not in _limiters:
+            _limiters[api] = Limiter(RATES[api], CONCURRENCY[api])
+        return _limiters[api]
+
+
+def api_of(url):
+    host = urlparse(url).hostname or ""
+    return "sheets" if host.startswith("sheets.") else "drive"
+
+
+def is_quota_response(r):
+    """Return true if response `r` tells to slow down"""
+    if not isinstance(r, requests.Response):
+        return False
+    if r.status_code in (429, 503):
+        return True
+    if r.status_code == 403:
+        return any(reason in r.text for reason in QUOTA_REASONS)
+    return False
+
+
+def retry_after(r):
+    """Return delay in seconds from Retry-After header of response `r`"""
+    if not isinstance(r, requests.Response) \
+       or (value := r.headers.get("Retry-After")) is None:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp()
+                   - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class Adapter(requests.adapters.HTTPAdapter):
+    """Transport adapter passing requests through the API limiters"""
+
+    def send(self, request, **kwargs):
+        return limiter(api_of(request.url)).call(
+            lambda: super(Adapter, self).send(request, **kwargs),
+            is_quota_response, retry_after)
+
+
+def mount(session):
+    """Make requests of `session` go through the API limiters"""
+    adapter = Adapter(pool_maxsize=32)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def is_quota_error(e):
+    """Return true if PyDrive2 API error `e` tells to slow down"""
+    error = getattr(e, "error", None)
+    if not isinstance(error, dict):
+        return False
+    reasons = [err.get("reason") for err in error.get("errors", [])]
+    return error.get("code") in (429, 503) or (
+        error.get("code") == 403
+        and any(r in QUOTA_REASONS for r in reasons))
+
+
+def call(api, func):
+    """Return result of `func()` calling `api` by other clients
+       (PyDrive2) within the limits of `api`"""
+    return limiter(api).call(func, is_quota_error)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import contextlib
+import os
+import pathlib
+import threading
+
+from collections import deque
+
+import utils as ut
+
+
+class FairLimiter:
+    """Limit concurrent use of a resource to `limit` slots.
+       When the slots are busy, they are granted to waiting jobs
+       in turn, so a job with many fragments can't starve the others"""
+
+    def __init__(self, limit):
+        self.free = max(limit, 1)
+        self.lock = threading.Lock()
+        self.waiting = {}     # queues of events by job
+        self.turn = deque()   # jobs in order to be served
+
+    def acquire(self, job):
+        with self.lock:
+            if self.free > 0 and not self.turn:
+                self.free -= 1
+                return
+            event = threading.Event()
+            if job not in self.waiting:
+                self.waiting[job] = deque()
+                self.turn.append(job)
+            self.waiting[job].append(event)
+        event.wait()  # the slot is handed over by `release`
+
+    def release(self):
+        with self.lock:
+            if not self.turn:
+                self.free += 1
+                return
+            job = self.turn.popleft()
+            event = self.waiting[job].popleft()
+            if self.waiting[job]:
+                self.turn.append(job)  # to the end of the line
+            else:
+                del self.waiting[job]
+        event.set()
+
+    @contextlib.contextmanager
+    def slot(self, job):
+        self.acquire(job)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Limits:
+    """Global limits of concurrent downloads, ffmpeg processes
+       and uploads shared by jobs. No limits if `limits` is None"""
+
+    def __init__(self, limits=None):
+        self.enabled = limits is not None
+        limits = limits or {}
+        self.download = FairLimiter(limits.get("downloads") or 1)
+        self.cut = FairLimiter(limits.get("cuts") or os.cpu_count())
+        self.upload = FairLimiter(limits.get("uploads") or 4)
+
+    def slot(self, kind, job):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return getattr(self, kind).slot(job)
+
+
+def job_args(args, i):
+    """Return settings of `i`-th job in batch settings `args`,
+       the common settings are overridden by the job ones"""
+    common = {k: v for k, v in args.items() if k not in ("jobs", "limits")}
+    job = {**common, **args["jobs"][i]}
+    job.setdefault("name", f"job{i+1}")
+    if "temporary_dir" not in args["jobs"][i]:  # not to mix jobs' files
+        job["temporary_dir"] = pathlib.Path(common["temporary_dir"]) \
+                               / job["name"]
+    return job
+
+
+def run_batch(args, make_job, stat):
+    """Run all jobs of batch settings `args` at once sharing global
+       limits, `make_job(args, limits)` creates a job. Return dict
+       of statistics by job name, `stat` is updated with the totals"""
+    limits = Limits(args.get("limits", {}))
+    stats = {}
+    lock = threading.Lock()
+
+    def run(i):
+        job_stat = ut.Statistics()
+        name = f"job{i+1}"
+        try:
+            jargs = job_args(args, i)
+            name = jargs["name"]
+            job = make_job(jargs, limits)
+            tm_codes = job.plan(job_stat)
+            print(f"[{name}] Extracted {len(tm_codes)} time code(s)")
+            job.run(tm_codes, job_stat)
+        except Exception:
+            ut.logger().exception(f"job '{name}' failed")
+            print(f"[{name}] [FAILED] see the log file for details")
+            job_stat.failed += 1
+        with lock:
+            stats[name] = job_stat
+            stat.add(job_stat)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(args["jobs"]))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return stats
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+import html
+import http.server
+import json
+import pathlib
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from concurrent import futures
+from urllib.parse import urlparse
+
+import cut
+import driveindex
+import google_serve as gs
+import scheduler
+import utils as ut
+import version as vrs
+
+from job import Job
+
+
+# settings a submitted job may give, the rest are the server ones
+JOB_SETTINGS = (
+    "name", "video_url", "worksheet_url", "output_dir_url",
+    "n_head_rows", "head_row", "columns", "correct", "do_upload",
+    "partial_fetch", "batch_cut", "smart_cut", "transcode",
+    "transcode_chunk", "stream_upload",
+)
+REQUIRED = ("video_url", "worksheet_url", "output_dir_url")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+END = "end"  # the last event of a job
+
+
+class Events:
+    """Progress events of a job kept to be streamed to any number
+       of clients, each of them from where it is"""
+
+    def __init__(self):
+        self.items = []  # (type, data)
+        self.ended = False
+        self.cond = threading.Condition()
+
+    def publish(self, type, data):
+        with self.cond:
+            self.items.append((type, data))
+            self.ended = type == END
+            self.cond.notify_all()
+
+    def wait(self, n, timeout):
+        """Return events from `n`-th one, waiting up to `timeout`
+           seconds if there are none yet"""
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.items) > n, timeout)
+            return self.items[n:]
+
+
+class ServerJob(Job):
+    """Job submitted to `server` publishing its progress as `events`.
+       Its source video and output folder index are shared with
+       other jobs of the same Drive files"""
+
+    def __init__(self, args, server):
+        super().__init__(args, server.limits)
+        self.server = server
+        self.id = args["name"]
+        self.title = args.get("title") or self.id
+        self.state = QUEUED
+        self.error = None
+        self.events = Events()
+        self.stat = ut.Statistics()
+        self.sent = 0  # time of the last download event
+
+    def prepare(self, tm_codes):
+        if self.folder is None:
+            self.folder = self.server.folder(self.outdir_id)
+        super().prepare(tm_codes)
+
+    def downloading(self, n_bytes, total):
+        now = time.monotonic()
+        if now - self.sent >= 1 or n_bytes == total:
+            self.sent = now
+            self.events.publish("download", {"bytes": n_bytes,
+                                             "total": total})
+
+    def report(self, line):
+        data = {"text": " ".join(f"{item}" for item in line)}
+        if m := re.fullmatch(r"(\d+)/(\d+)", f"{line[0]}"):
+            data.update(done=int(m.group(1)), total=int(m.group(2)))
+        self.events.publish("fragment", data)
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.title,
+            "state": self.state,
+            "error": self.error,
+            "total": self.stat.total,
+            "ready": self.stat.ready,
+            "uploaded": self.stat.uploaded,
+            "failed": self.stat.failed,
+        }
+
+    def set_state(self, state):
+        self.state = state
+        self.events.publish(END if state in (DONE, FAILED) else "state",
+                            self.summary())
+
+
+class JobServer:
+    """Jobs submitted by several users run by a pool of `jobs` threads
+       within global limits (see `scheduler.Limits`) of server settings
+       `args`. Source videos are downloaded once to the shared cache and
+       output folder indexes are shared by jobs of the same folder"""
+
+    def __init__(self, args):
+        self.args = args
+        self.limits = scheduler.Limits(args.get("limits") or {})
+        self.tempdir = pathlib.Path(args["temporary_dir"])
+        self.cache = args.get("source_cache") or self.tempdir/"sources"
+        conf = args.get("server") or {}
+        self.pool = futures.ThreadPoolExecutor(conf.get("jobs") or 2, "job")
+        self.jobs = {}  # by ID in order of submission
+        self.folders = {}
+        self.lock = threading.Lock()
+
+    def folder(self, id):
+        """Return index of output folder `id` shared by jobs"""
+        with self.lock:
+            if id not in self.folders:
+                dir = self.tempdir/"indexes"
+                dir.mkdir(parents=True, exist_ok=True)
+                self.folders[id] = driveindex.FolderIndex(
+                    gs.get_session(ut.checked_path(self.args["auth_token"])),
+                    id, dir/f"{id}.json")
+            return self.folders[id]
+
+    def submit(self, settings):
+        """Queue job with `settings`, return it"""
+        if not isinstance(settings, dict):
+            raise ValueError("job settings must be an object")
+        if unknown := set(settings) - set(JOB_SETTINGS):
+            raise ValueError(f"settings {sorted(unknown)} can't be given")
+        if missing := [k for k in REQUIRED if not settings.get(k)]:
+            raise ValueError(f"settings {missing} are missing")
+        transcode = settings.get("transcode")
+        if transcode is not None and (not isinstance(transcode, str)
+                                      or transcode not in cut.PROFILES):
+            # ffmpeg arguments would give access to files of the server
+            raise ValueError(f"transcode must be one of"
+                             f" {sorted(cut.PROFILES)}")
+        id = uuid.uuid4().hex[:8]
+        common = {k: v for k, v in self.args.items()
+                  if k not in ("jobs", "limits", "server")}
+        job = ServerJob({
+            **common, **settings,
+            "name": id,  # to take turns for limits
+            "title": settings.get("name"),
+            "temporary_dir": self.tempdir/"jobs"/id,
+            "source_cache": self.cache,
+        }, self)
+        with self.lock:
+            self.jobs[id] = job
+        job.set_state(QUEUED)
+        self.pool.submit(self.run, job)
+        return job
+
+    def run(self, job):
+        job.set_state(RUNNING)
+        try:
+            tm_codes = job.plan(job.stat)
+            job.report([f"Extracted {len(tm_codes)} time code(s)"])
+            job.run(tm_codes, job.stat)
+        except Exception as e:
+            ut.logger().exception(f"job '{job.id}' failed")
+            job.error = f"{e}"
+            job.set_state(FAILED)
+            return
+        job.set_state(DONE)
+        if job.args["do_upload"] and not job.stat.failed:
+            shutil.rmtree(job.tempdir, ignore_errors=True)  # all on Drive
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(id)
+
+    def list(self):
+        with self.lock:
+            return [job.summary() for job in self.jobs.values()]
+
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>cut-m {version}</title></head>
+<body>
+<h1>cut-m</h1>
+<form id="form">
+<textarea id="settings" rows="8" cols="80">{{
+  "name": "",
+  "video_url": "",
+  "worksheet_url": "",
+  "output_dir_url": ""
+}}</textarea><br>
+<button>Submit</button> <span id="error"></span>
+</form>
+<div id="jobs"></div>
+<script>
+function follow(job) {{
+  const pre = document.createElement("pre");
+  pre.textContent = `[${{job.name}}] ${{job.state}}\\n`;
+  document.getElementById("jobs").prepend(pre);
+  const source = new EventSource(`/jobs/${{job.id}}/events`);
+  for (const type of ["state", "download", "fragment", "end"]) {{
+    source.addEventListener(type, e => {{
+      const d = JSON.parse(e.data);
+      pre.textContent += type == "fragment" ? d.text
+        : type == "download" ? `download ${{d.bytes}} of ${{d.total}} B`
+        : `${{d.state}} ${{d.error || ""}}`;
+      pre.textContent += "\\n";
+      if (type == "end") source.close();
+    }});
+  }}
+}}
+document.getElementById("form").onsubmit = async e => {{
+  e.preventDefault();
+  const r = await fetch("/jobs", {{method: "POST",
+    body: document.getElementById("settings").value}});
+  const data = await r.json();
+  document.getElementById("error").textContent = data.error || "";
+  if (r.ok) follow(data);
+}};
+fetch("/jobs").then(r => r.json()).then(jobs => jobs.forEach(follow));
+</script>
+</body></html>
+"""
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """HTTP API of the job server:
+       GET /jobs, POST /jobs (settings in JSON), GET /jobs/<id>
+       and GET /jobs/<id>/events (Server-Sent Events)"""
+
+    server_version = f"cut-m/{vrs.get_version()}"
+
+    def log_message(self, format, *args):
+        ut.logger().debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, code, body, type="application/json; charset=utf-8"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", type)
+        self.send_header("Content-Length", f"{len(body)}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        app = self.server.app
+        path = urlparse(self.path).path.rstrip("/")
+        if path == "":
+            page = PAGE.format(version=html.escape(vrs.get_version()))
+            return self._send(200, page.encode("utf-8"),
+                              "text/html; charset=utf-8")
+        if path == "/jobs":
+            return self._send(200, app.list())
+        m = re.fullmatch(r"/jobs/(\w+)(/events)?", path)
+        if m is None or (job := app.get(m.group(1))) is None:
+            return self._send(404, {"error": "not found"})
+        if m.group(2) is None:
+            return self._send(200, job.summary())
+        self._stream(job)
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            return self._send(404, {"error": "not found"})
+        try:
+            n = int(self.headers.get("Content-Length") or 0)
+            job = self.server.app.submit(json.loads(self.rfile.read(n)))
+        except Exception as e:  # bad settings
+            return self._send(400, {"error": f"{e}"})
+        self._send(202, job.summary())
+
+    def _stream(self, job):
+        """Send events of `job` as they come until it ends"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:  # reconnected
+            n = max(int(self.headers.get("Last-Event-ID") or -1) + 1, 0)
+        except ValueError:
+            n = 0
+        try:
+            while True:
+                events = job.events.wait(n, timeout=15)
+                if not events and job.events.ended:  # seen all
+                    return
+                if not events:
+                    self.wfile.write(b": keep-alive\n\n")
+                for type, data in events:
+                    data = json.dumps(data, ensure_ascii=False)
+                    self.wfile.write(f"id: {n}\nevent: {type}\n"
+                                     f"data: {data}\n\n".encode("utf-8"))
+                    n += 1
+                    if type == END:
+                        return
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            ut.logger().debug(f"events of job '{job.id}' are left")
+
+
+def serve(args):
+    """Run job server by settings `args` until interrupted"""
+    conf = args.get("server") or {}
+    host, port = conf.get("host") or "127.0.0.1", conf.get("port") or 8080
+    httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True  # event streams don't hold it
+    httpd.app = JobServer(args)
+    print(f"Serving at http://{host}:{port}")
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        httpd.app.pool.shutdown(wait=False, cancel_futures=True)
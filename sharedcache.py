@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import pathlib
+
+import download
+import utils as ut
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+class FileLock:
+    """Exclusive lock of `file` between processes and threads.
+       It is released by OS if the holder dies, so it can't go stale"""
+
+    def __init__(self, file):
+        self.file = file
+        self.f = None
+
+    def _lock(self, blocking):
+        if os.name == "nt":
+            mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+            while True:
+                try:
+                    msvcrt.locking(self.f.fileno(), mode, 1)
+                    return True
+                except OSError:  # LK_LOCK gives up in 10 seconds
+                    if not blocking:
+                        return False
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX
+                        | (0 if blocking else fcntl.LOCK_NB))
+            return True
+        except BlockingIOError:
+            return False
+
+    def acquire(self, blocking=True):
+        """Take the lock, return false if it is busy and not `blocking`"""
+        self.f = open(self.file, "a+b")
+        if self._lock(blocking):
+            return True
+        self.f.close()
+        self.f = None
+        return False
+
+    def release(self):
+        if os.name == "nt":
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()  # unlocks with flock
+        self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class SourceCache:
+    """Source videos shared by processes in directory `dir`.
+
+       A video is kept as `<dir>/<Drive ID>.<MD5>/<name>`, so a changed
+       file gets a new entry. Exactly one process downloads it holding
+       a lock file, the others wait and reuse the finished file, which
+       is published by an atomic rename"""
+
+    def __init__(self, dir):
+        self.dir = pathlib.Path(dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, id, md5, name, fetch):
+        """Return cached file `name` of Drive file `id` with `md5`
+           checksum. If it is not cached yet, `fetch(target)` is called
+           to download it into temporary `target`"""
+        entry = self.dir/f"{id}.{md5}"
+        file = entry/name
+        if file.exists():
+            ut.logger().debug(f"'{file}' is in shared cache")
+            return file
+
+        lock = FileLock(self.dir/f"{id}.{md5}.lock")
+        if not lock.acquire(blocking=False):
+            print("> waiting for another process to download the video")
+            lock.acquire()
+        try:
+            if file.exists():  # downloaded while waiting
+                return file
+            entry.mkdir(exist_ok=True)
+            part = file.with_name(f"{name}.part")  # resumed if interrupted
+            fetch(part)
+            os.replace(part, file)
+            if (md5_file := download.verified_file(part)).exists():
+                # a rename keeps the stamp of the file valid
+                os.replace(md5_file, download.verified_file(file))
+            ut.logger().debug(f"'{file}' is published to shared cache")
+        finally:
+            lock.release()
+        return file
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# modules of the application are at the top level of the repository
+sys.path.insert(0, f"{pathlib.Path(__file__).resolve().parents[1]}")
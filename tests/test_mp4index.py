@@ -0,0 +1,29 @@
+import shutil
+import subprocess
+
+import pytest
+
+import mp4index
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None,
+                                reason="no ffmpeg")
+
+
+def make_video(path, *args):
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi",
+                    "-i", "testsrc=duration=4:size=64x48:rate=25",
+                    "-g", "25", *args, "-y", f"{path}"], check=True)
+    return path
+
+
+def test_index_of_plain_file(tmp_path):
+    index = mp4index.load(make_video(tmp_path/"plain.mp4"))
+    assert len(index.tracks[0].times) == 100
+    assert index.keyframes() == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_fragmented_file_is_rejected(tmp_path):
+    video = make_video(tmp_path/"fragmented.mp4",
+                       "-movflags", "frag_keyframe+empty_moov")
+    with pytest.raises(mp4index.FormatError):
+        mp4index.load(video)
@@ -0,0 +1,25 @@
+import atexit
+import logging
+import re
+
+import utils as ut
+
+
+def test_log_line_is_formatted_once(tmp_path):
+    file = tmp_path/"test.log"
+    listener = ut._start_logging(file)
+    root = logging.getLogger()
+    added = root.handlers[-1]
+    level = ut.logger().level
+    ut.logger().setLevel(logging.DEBUG)
+    try:
+        ut.logger().debug("hello")
+    finally:
+        ut.logger().setLevel(level)
+        root.removeHandler(added)
+        atexit.unregister(listener.stop)
+        listener.stop()  # flush the queue
+    lines = file.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 1
+    assert re.fullmatch(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}"
+                        r":test_utils:DEBUG: hello", lines[0])
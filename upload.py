@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import json
+import mimetypes
+import os
+import threading
+import time
+
+import requests
+
+import utils as ut
+
+
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+FIELDS = "id,name,mimeType,size,md5Checksum,parents,appProperties"
+CHUNK_UNIT = 256 * 1024  # Drive requires chunks multiple of 256 KB
+
+
+class UploadError(RuntimeError):
+    pass
+
+
+class Sessions:
+    """Resumable upload sessions saved in JSON `file`
+       to continue interrupted uploads on the next run"""
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.data = {}
+        if file.exists():
+            with file.open("r", encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    @staticmethod
+    def key(path, parent):
+        st = path.stat()
+        return f"{parent}/{path.name}:{st.st_size}:{st.st_mtime_ns}"
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def put(self, key, uri):
+        with self.lock:
+            self.data[key] = uri
+            self._save()
+
+    def drop(self, key):
+        with self.lock:
+            if self.data.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp = self.file.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(tmp, self.file)
+
+
+class Uploader:
+    """Upload files to Google Drive by the resumable upload protocol.
+
+       `session` is an authorized `requests.Session`, `sessions` keeps
+       upload session URIs. Files are sent in chunks of `chunk_size` bytes
+       and an interrupted upload continues from the last confirmed byte.
+       Thread-safe if `session` is, so several uploads may be in flight"""
+
+    def __init__(self, session, sessions, chunk_size=8*1024*1024,
+                 retries=5, url=UPLOAD_URL):
+        self.session = session
+        self.sessions = sessions
+        self.chunk_size = max(chunk_size // CHUNK_UNIT, 1) * CHUNK_UNIT
+        self.retries = retries
+        self.url = url
+
+    def upload(self, path, parent, callback=None, properties=None):
+        """Upload file at `path` to Google Drive folder with `parent` ID
+           and private app `properties` (dict of strings), return
+           metadata of the uploaded file"""
+        size = path.stat().st_size
+        key = Sessions.key(path, parent)
+        uri = self.sessions.get(key)
+        offset = None
+        if uri is not None:
+            offset = self._query(uri, size)
+            if isinstance(offset, dict):  # already completed
+                self.sessions.drop(key)
+                return offset
+            ut.logger().debug(f"resume upload of '{path.name}'"
+                              f" from {offset}")
+        if offset is None:
+            uri = self._start(path.name, parent, size, properties)
+            self.sessions.put(key, uri)
+            offset = 0
+
+        attempt = 0
+        with path.open("rb") as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                try:
+                    result = self._put(uri, chunk, offset, size)
+                except (requests.ConnectionError, requests.Timeout,
+                        UploadError) as e:
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+                    ut.logger().warning(f"upload of '{path.name}' failed"
+                                        f" at {offset}, retry: {e}")
+                    time.sleep(min(2**attempt, 64))
+                    try:
+                        result = self._query(uri, size)
+                    except (requests.ConnectionError, requests.Timeout,
+                            UploadError):
+                        continue  # try the same chunk once more
+                    if result is None:  # session expired, start over
+                        uri = self._start(path.name, parent, size,
+                                          properties)
+                        self.sessions.put(key, uri)
+                        result = 0
+                else:
+                    attempt = 0
+                if isinstance(result, dict):
+                    self.sessions.drop(key)
+                    return result
+                offset = result
+                if callback is not None:
+                    callback(offset, size)
+
+    def upload_stream(self, stream, name, parent, finish=None,
+                      properties=None):
+        """Upload file `name` read from binary `stream` of unknown size
+           (e.g. ffmpeg output pipe) to Google Drive folder with `parent`
+           ID and `properties` like `upload`, return metadata of the
+           uploaded file.
+
+           Only the current chunk is kept in memory and sent again if it
+           fails. At the end of the stream `finish()` is called, the upload
+           is cancelled unless it returns true. UploadError is raised if
+           the upload can't be continued, the data is lost then"""
+        uri = self._start(name, parent, properties=properties)
+        offset = 0
+        chunk = _read(stream, self.chunk_size)
+        try:
+            while True:
+                last = len(chunk) < self.chunk_size
+                if last and finish is not None and not finish():
+                    raise UploadError(f"stream of '{name}' is broken")
+                size = offset + len(chunk) if last else "*"
+                result = self._put_retried(uri, chunk, offset, size, name)
+                if isinstance(result, dict):
+                    return result
+                if result < offset:
+                    raise UploadError(f"upload of '{name}' is rolled back"
+                                      f" to {result}")
+                chunk, offset = chunk[result - offset:], result
+                if not last:
+                    chunk += _read(stream, self.chunk_size - len(chunk))
+        except BaseException:
+            self._cancel(uri)
+            raise
+
+    def _put_retried(self, uri, chunk, offset, size, name):
+        """Send `chunk` retrying on errors, return the confirmed offset
+           or metadata if completed"""
+        attempt = 0
+        while True:
+            try:
+                return self._put(uri, chunk, offset, size)
+            except (requests.ConnectionError, requests.Timeout,
+                    UploadError) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                ut.logger().warning(f"upload of '{name}' failed"
+                                    f" at {offset}, retry: {e}")
+                time.sleep(min(2**attempt, 64))
+                try:
+                    result = self._query(uri, size)
+                except (requests.ConnectionError, requests.Timeout,
+                        UploadError):
+                    continue  # try the same chunk once more
+                if result is None:
+                    raise UploadError(f"upload session of '{name}'"
+                                      " is expired")
+                if isinstance(result, dict) or result != offset:
+                    return result
+
+    def _cancel(self, uri):
+        try:
+            self.session.delete(uri)
+        except requests.RequestException:
+            pass  # expires anyway
+
+    def _start(self, name, parent, size=None, properties=None):
+        """Start upload session of file `name`, return its URI.
+           The `size` may be unknown until the last chunk"""
+        meta = {"name": name, "parents": [parent]}
+        if properties:
+            meta["appProperties"] = properties
+        mime = mimetypes.guess_type(name)[0] or "video/mp4"
+        headers = {"X-Upload-Content-Type": mime}
+        if size is not None:
+            headers["X-Upload-Content-Length"] = f"{size}"
+        r = self.session.post(
+            self.url,
+            params={"uploadType": "resumable", "fields": FIELDS},
+            headers=headers,
+            json=meta,
+        )
+        if r.status_code != 200 or "Location" not in r.headers:
+            raise UploadError(f"failed to start upload of '{name}'"
+                              f" ({r.status_code} {r.text})")
+        return r.headers["Location"]
+
+    def _put(self, uri, chunk, offset, size):
+        end = offset + len(chunk) - 1
+        headers = {"Content-Range": f"bytes {offset}-{end}/{size}"}
+        if not chunk:  # empty file
+            headers = {"Content-Range": f"bytes */{size}"}
+        r = self.session.put(uri, data=chunk, headers=headers)
+        return self._result(r)
+
+    def _query(self, uri, size):
+        """Return confirmed offset of upload session `uri`, metadata
+           if completed or None if the session is no longer valid"""
+        r = self.session.put(uri, headers={
+            "Content-Range": f"bytes */{size}"
+        })
+        if r.status_code in (404, 410):
+            return None
+        return self._result(r)
+
+    @staticmethod
+    def _result(r):
+        if r.status_code in (200, 201):
+            return r.json()
+        if r.status_code == 308:
+            if (rng := r.headers.get("Range")) is None:
+                return 0
+            return int(rng.rsplit("-", 1)[1]) + 1
+        raise UploadError(f"unexpected response ({r.status_code} {r.text})")
+
+
+def _read(stream, n):
+    """Read `n` bytes from `stream`, less only at its end"""
+    data = bytearray()
+    while len(data) < n and (b := stream.read(n - len(data))):
+        data += b
+    return bytes(data)
@@ -1,11 +1,19 @@
 #!/usr/bin/python3
 
+import atexit
+import contextlib
 import datetime
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import re
 import pathlib
 import shutil
+import subprocess as sp
 import sys
+import threading
 import time
 
 
@@ -20,8 +28,17 @@ def humansize(nbytes):
     raise RuntimeError("unreachable code point")
 
 
+# upper bounds of latency histogram buckets in seconds
+HISTOGRAM_BOUNDS = (0.1, 0.3, 1, 3, 10, 30, 100, 300)
+
+
 class Statistics:
-    """Statistics base"""
+    """Statistics base.
+
+       Besides the counters of fragments, it records spans of work
+       by stage (see `span`): their durations, bytes moved and CPU time
+       of child processes, to be reported as JSON (see `as_dict`)
+       or as a Chrome trace timeline (see `save_trace`)"""
 
     def __init__(self):
         self.total = 0
@@ -29,6 +46,119 @@ class Statistics:
         self.failed = 0
         self.uploaded = 0
         self.start_time = time.time()
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def add(self, other):
+        """Add counters and spans of `other` statistics"""
+        self.total += other.total
+        self.ready += other.ready
+        self.failed += other.failed
+        self.uploaded += other.uploaded
+        with self.lock:
+            self.spans += other.spans
+
+    @contextlib.contextmanager
+    def span(self, stage, item=None, **args):
+        """Record span of `stage` of work on `item` (a fragment name)
+           done in the block. The yielded dict of span arguments may be
+           updated with "bytes" moved, CPU time of child processes run
+           by `run_process` in the current thread is counted"""
+        rec = {"bytes": 0, **args}
+        cpu = cpu_time()
+        start = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec["seconds"] = time.perf_counter() - start
+            rec["cpu"] = round(cpu_time() - cpu, 6)
+            rec.update(stage=stage, item=item, start=start,
+                       tid=threading.get_native_id())
+            with self.lock:
+                self.spans.append(rec)
+
+    def stages(self):
+        """Return summary of spans by stage"""
+        with self.lock:
+            spans = list(self.spans)
+        stages = {}
+        for s in spans:
+            stages.setdefault(s["stage"], []).append(s)
+
+        result = {}
+        for name, spans in stages.items():
+            durations = sorted(s["seconds"] for s in spans)
+            seconds = sum(durations)
+            n_bytes = sum(s["bytes"] for s in spans)
+            hist = {f"<={b}": 0 for b in HISTOGRAM_BOUNDS}
+            hist[f">{HISTOGRAM_BOUNDS[-1]}"] = 0
+            for d in durations:
+                for b in HISTOGRAM_BOUNDS:
+                    if d <= b:
+                        hist[f"<={b}"] += 1
+                        break
+                else:
+                    hist[f">{HISTOGRAM_BOUNDS[-1]}"] += 1
+            result[name] = {
+                "count": len(spans),
+                "seconds": round(seconds, 3),
+                "bytes": n_bytes,
+                "cpu": round(sum(s["cpu"] for s in spans), 3),
+                "MB/s": round(n_bytes / seconds / 1e6, 2) if seconds else 0,
+                "p50": round(durations[len(durations) // 2], 3),
+                "p90": round(durations[int(0.9*(len(durations) - 1))], 3),
+                "max": round(durations[-1], 3),
+                "histogram": hist,
+            }
+        return result
+
+    def as_dict(self):
+        """Return machine-readable report"""
+        fragments = {}
+        with self.lock:
+            spans = list(self.spans)
+        for s in spans:
+            if s["item"] is not None:
+                f = fragments.setdefault(s["item"], {})
+                f[s["stage"]] = round(f.get(s["stage"], 0) + s["seconds"], 3)
+        return {
+            "elapsed": round(time.time() - self.start_time, 3),
+            "total": self.total,
+            "ready": self.ready,
+            "failed": self.failed,
+            "uploaded": self.uploaded,
+            "stages": self.stages(),
+            "fragments": fragments,
+        }
+
+    def save(self, file):
+        """Save report (see `as_dict`) to JSON `file`"""
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, indent=1, ensure_ascii=False)
+
+    def save_trace(self, file):
+        """Save spans to `file` in Chrome trace format, which may be
+           opened by chrome://tracing or https://ui.perfetto.dev"""
+        with self.lock:
+            spans = list(self.spans)
+        events = []
+        for s in spans:
+            args = {k: v for k, v in s.items()
+                    if k not in ("stage", "item", "start", "seconds", "tid")}
+            events.append({
+                "name": s["item"] or s["stage"],
+                "cat": s["stage"],
+                "ph": "X",
+                "ts": round((s["start"] - self.origin) * 1e6),
+                "dur": round(s["seconds"] * 1e6),
+                "pid": os.getpid(),
+                "tid": s["tid"],
+                "args": args,
+            })
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f,
+                      ensure_ascii=False)
 
     def elapsed(self):
         dt = time.time() - self.start_time
@@ -54,6 +184,47 @@ class Statistics:
         print(f"  - Newly uploaded: {self.uploaded} files/загружено сейчас")
         print(f"  - Failed: {self.failed} files/не удалось обработать")
         print()
+        if stages := self.stages():
+            print("Stages/Этапы:")
+            for name, s in stages.items():
+                line = f"  - {name}: {s['count']} x {s['p50']} s (median)," \
+                       f" {s['seconds']} s total"
+                if s["bytes"]:
+                    line += f", {humansize(s['bytes'])} at {s['MB/s']} MB/s"
+                if s["cpu"]:
+                    line += f", CPU {s['cpu']} s"
+                print(line)
+            print()
+
+
+_local = threading.local()  # counters of the current thread
+
+
+def cpu_time():
+    """Return CPU time of child processes run by `run_process`
+       in the current thread"""
+    return getattr(_local, "cpu", 0.)
+
+
+def count_cpu(seconds):
+    """Count CPU time of child processes run by other threads
+       on behalf of the current one (see `cpu_time`)"""
+    _local.cpu = cpu_time() + seconds
+
+
+def run_process(args):
+    """Run command `args` and return `subprocess.CompletedProcess`
+       with captured stderr. Its CPU time is counted (see `cpu_time`)"""
+    p = sp.Popen(args, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    if not hasattr(os, "wait4"):  # no resource usage on Windows
+        _, err = p.communicate()
+        return sp.CompletedProcess(args, p.returncode, None, err)
+    with p.stderr:
+        err = p.stderr.read()
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    _local.cpu = cpu_time() + usage.ru_utime + usage.ru_stime
+    return sp.CompletedProcess(args, p.returncode, None, err)
 
 
 def application_path():
@@ -70,9 +241,26 @@ log_level = {
 }
 
 
-logging.basicConfig(filename="cut-m.log", encoding="utf-8",
-                    format="%(asctime)s:%(module)s:%(levelname)s: %(message)s",
-                    level=logging.CRITICAL)
+def _start_logging(file):
+    """Log to `file` by a background thread, so logging calls
+       don't wait for file I/O"""
+    handler = logging.FileHandler(file, encoding="utf-8")
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s:%(module)s:%(levelname)s: %(message)s"))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    enqueue = logging.handlers.QueueHandler(records)
+    # the message only, it is formatted by the file handler
+    enqueue.setFormatter(logging.Formatter("%(message)s"))
+    root = logging.getLogger()
+    root.addHandler(enqueue)
+    root.setLevel(logging.CRITICAL)
+    listener.start()
+    atexit.register(listener.stop)  # flush the queue
+    return listener
+
+
+_start_logging("cut-m.log")
 
 
 def logger():
@@ -133,6 +321,11 @@ def to_seconds(hhmmss):
     return s
 
 
+def decode(data):
+    """Return string decoded from bytes `data` of a process output"""
+    return data.decode("utf-8", errors="replace")
+
+
 def as_suffix(start, end):
     start, end = start.replace(":", "."), end.replace(":", ".")
     return f"_{start}-{end}"
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import google_serve as gs
+import utils as ut
+
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+class WorkQueue:
+    """Durable queue of time codes in SQLite `file` to be processed by
+       workers on several machines (the file is on shared storage).
+
+       A worker leases items for `lease` seconds and renews the lease
+       while it works. An item with an expired lease is given to another
+       worker. Every lease has a token, so only the last holder of an item
+       may complete it and it is recorded done exactly once. Items failed
+       `max_attempts` times are not given out any more"""
+
+    def __init__(self, file, lease=600, max_attempts=3):
+        self.file, self.lease = file, lease
+        self.max_attempts = max_attempts
+        self.local = threading.local()
+        with self._db() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS items (
+                key TEXT PRIMARY KEY,
+                job TEXT NOT NULL,
+                tm_code TEXT NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                token TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS by_state"
+                       " ON items (job, state)")
+
+    def _db(self):
+        """Return connection of the current thread"""
+        if getattr(self.local, "db", None) is None:
+            self.local.db = sqlite3.connect(self.file, timeout=60,
+                                            isolation_level=None)
+        return _Transaction(self.local.db)
+
+    def put(self, job, tm_codes):
+        """Add `tm_codes` of `job`, return number of new ones"""
+        with self._db() as db:
+            n = 0
+            for tm in tm_codes:
+                n += db.execute(
+                    "INSERT OR IGNORE INTO items (key, job, tm_code, state)"
+                    " VALUES (?, ?, ?, ?)",
+                    (json.dumps([job, *tm]), job, json.dumps(tm), PENDING)
+                ).rowcount
+        return n
+
+    def claim(self, job, worker, n=1):
+        """Lease up to `n` items of `job` to `worker`,
+           return list of (key, time code, token)"""
+        now = time.time()
+        with self._db() as db:
+            rows = db.execute(
+                "SELECT key, tm_code FROM items WHERE job = ?"
+                " AND (state = ? OR state = ? AND lease_until < ?)"
+                " AND attempts < ? ORDER BY rowid LIMIT ?",
+                (job, PENDING, LEASED, now, self.max_attempts, n)
+            ).fetchall()
+            items = []
+            for key, tm in rows:
+                token = uuid.uuid4().hex
+                db.execute(
+                    "UPDATE items SET state = ?, worker = ?, token = ?,"
+                    " lease_until = ?, attempts = attempts + 1"
+                    " WHERE key = ?",
+                    (LEASED, worker, token, now + self.lease, key))
+                items.append((key, gs.TmCode(*json.loads(tm)), token))
+            # items leased too many times are failed
+            db.execute(
+                "UPDATE items SET state = ? WHERE job = ? AND state = ?"
+                " AND lease_until < ? AND attempts >= ?",
+                (FAILED, job, LEASED, now, self.max_attempts))
+        return items
+
+    def renew(self, items):
+        """Extend leases of `items` (see `claim`)"""
+        with self._db() as db:
+            for key, _, token in items:
+                db.execute(
+                    "UPDATE items SET lease_until = ?"
+                    " WHERE key = ? AND token = ? AND state = ?",
+                    (time.time() + self.lease, key, token, LEASED))
+
+    def complete(self, item, result=None):
+        """Record leased `item` done with `result`,
+           return false if its lease is lost"""
+        key, _, token = item
+        with self._db() as db:
+            return db.execute(
+                "UPDATE items SET state = ?, result = ?, lease_until = NULL"
+                " WHERE key = ? AND token = ? AND state = ?",
+                (DONE, json.dumps(result), key, token, LEASED)).rowcount == 1
+
+    def fail(self, item):
+        """Return leased `item` to the queue to be retried,
+           unless it has failed too many times"""
+        key, _, token = item
+        with self._db() as db:
+            db.execute(
+                "UPDATE items SET state = CASE WHEN attempts < ?"
+                " THEN ? ELSE ? END, lease_until = NULL"
+                " WHERE key = ? AND token = ? AND state = ?",
+                (self.max_attempts, PENDING, FAILED, key, token, LEASED))
+
+    def counts(self, job):
+        """Return number of items of `job` by state"""
+        with self._db() as db:
+            rows = db.execute("SELECT state, COUNT(*) FROM items"
+                              " WHERE job = ? GROUP BY state", (job,))
+            return {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+
+class _Transaction:
+    """Context of a write transaction taken at once, so concurrent
+       workers can't lease the same item"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+
+
+def job_key(job):
+    """Return key of job items in the queue"""
+    return f"{job.video_id}/{job.outdir_id}"
+
+
+def coordinate(job, queue, stat, interval=10):
+    """Put time codes of `job` into `queue` and wait for them to be done"""
+    with stat.span("sheet"):
+        tm_codes = job.load_timing()
+    key = job_key(job)
+    n = queue.put(key, tm_codes)
+    print(f"Extracted {len(tm_codes)} time code(s), {n} new queued")
+    last = None
+    while True:
+        counts = queue.counts(key)
+        if counts != last:
+            print(f"{counts[DONE]} done, {counts[LEASED]} in progress,"
+                  f" {counts[PENDING]} pending, {counts[FAILED]} failed",
+                  flush=True)
+            last = counts
+        if not counts[PENDING] and not counts[LEASED]:
+            break
+        time.sleep(interval)
+    stat.total += sum(counts.values())
+    stat.uploaded += counts[DONE]
+    stat.failed += counts[FAILED]
+
+
+def work(job, queue, stat, interval=10):
+    """Process time codes of `job` from `queue` until none is left"""
+    key = job_key(job)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"Worker {worker}")
+    while True:
+        items = queue.claim(key, worker, job.workers)
+        if not items:
+            counts = queue.counts(key)
+            if not counts[PENDING] and not counts[LEASED]:
+                break
+            time.sleep(interval)  # wait for expired leases
+            continue
+
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(queue.lease / 3):
+                queue.renew(items)
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            failed = set(job.run([tm for _, tm, _ in items], stat))
+        except Exception:
+            ut.logger().exception("failed to process queued items")
+            failed = {tm for _, tm, _ in items}
+        finally:
+            stop.set()
+            beat.join()
+        for item in items:
+            tm = item[1]
+            if tm in failed:
+                queue.fail(item)
+                continue
+            file = job.ready(tm)
+            if not queue.complete(item, file and file.get("id")):
+                ut.logger().warning(f"lease of {tm} is lost,"
+                                    " done by another worker")